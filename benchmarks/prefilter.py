@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark the line filters against a synthetic Apache log.
+
+Compares the separate ``filter_by_method``, ``filter_by_date`` and
+``filter_by_ip`` stages, as they were before ``prefilter`` was added,
+with the fused ``prefilter`` stage, each followed by ``parse_into_dict``.
+A log of ``--size`` megabytes is generated in a temporary file unless one
+is passed with ``--log``::
+
+    (oastats)$ python benchmarks/prefilter.py --size 2048
+"""
+from __future__ import absolute_import, division, print_function
+import io
+import os
+import random
+import tempfile
+import time
+
+import click
+
+from pipeline.pipeline import parse_into_dict, prefilter
+
+
+LINE = u'{ip} - - [{day:02d}/{month}/2015:12:{minute:02d}:{second:02d} ' \
+       u'-0400] "{method} {url} HTTP/1.1" 200 666 "-" "ABrowser/5.0"\n'
+
+
+# The filters as they were before prefilter was added, so that the
+# baseline isn't sped up by later changes to the pipeline's versions.
+def filter_by_date(lines, dates=None):
+    for line in lines:
+        if not dates:
+            yield line
+        elif any([d in line for d in dates]):
+            yield line
+
+
+def filter_by_method(lines):
+    for line in lines:
+        if ' "GET ' in line:
+            yield line
+
+
+def filter_by_ip(lines, ip_addresses=('127.0.0.1', '18.7.27.25', '::1')):
+    for line in lines:
+        if not any([line.startswith(ip) for ip in ip_addresses]):
+            yield line
+
+
+def sample(count):
+    rand = random.Random(0)
+    lines = []
+    for _ in range(count):
+        if rand.random() < 0.05:
+            url = '/openaccess-disseminate/1721.1/{}'.format(
+                rand.randint(1, 99999))
+        else:
+            url = '/handle/1721.1/{}/browse?type=author'.format(
+                rand.randint(1, 99999))
+        lines.append(LINE.format(
+            ip=rand.choice(['18.1.1.1', '127.0.0.1', '93.184.216.34']),
+            day=rand.randint(1, 28), month=rand.choice(['Aug', 'Sep']),
+            minute=rand.randint(0, 59), second=rand.randint(0, 59),
+            method=rand.choice(['GET', 'GET', 'GET', 'HEAD']), url=url))
+    return u''.join(lines)
+
+
+def generate(path, size):
+    block = sample(10000)
+    written = 0
+    with io.open(path, 'w') as fp:
+        while written < size:
+            written += fp.write(block)
+
+
+def run(name, stages, path):
+    with io.open(path) as fp:
+        lines = sum(1 for _ in fp)
+    with io.open(path) as fp:
+        start = time.time()
+        matches = sum(1 for _ in stages(fp))
+        elapsed = time.time() - start
+    click.echo('{:<10} {:>12,.0f} lines/sec  {:>8.1f}s  {:,} of {:,} lines '
+               'parsed'.format(name, lines / elapsed, elapsed, matches,
+                               lines))
+
+
+@click.command()
+@click.option('--size', default=512, help='Size of log to generate in MB')
+@click.option('--log', type=click.Path(exists=True))
+@click.option('--month', '-m', multiple=True, default=['Aug/2015'])
+def main(size, log, month):
+    dates = list(month)
+    path = log
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix='.log')
+        os.close(fd)
+        generate(path, size * 2 ** 20)
+    try:
+        run('separate', lambda lines: parse_into_dict(filter_by_ip(
+            filter_by_date(filter_by_method(lines), dates))), path)
+        run('prefilter', lambda lines: parse_into_dict(
+            prefilter(lines, dates)), path)
+    finally:
+        if log is None:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,190 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
+from collections import OrderedDict
+from functools import wraps
+import hashlib
+import json
+import sqlite3
+import threading
+import time
 
-from dogpile.cache import make_region
 
+NO_VALUE = object()
 
-def key_gen(ns, fn, **kwargs):
-    fname = fn.__name__
 
-    def generate_key(*arg):
-        return fname + "_" + str(arg[0])
-    return generate_key
+class LRUCache(object):
+    """
+    A cache holding at most ``size`` of the most recently used items.
 
+    The number of hits, misses and evictions are counted for reporting.
+    """
 
-region = make_region(
-    function_key_generator=key_gen).configure('dogpile.cache.memory')
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        try:
+            value = self._items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._items[key] = value
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        while len(self._items) > self.size:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+    def resize(self, size):
+        self.size = size
+        while len(self._items) > size:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._items.clear()
+
+    def stats(self):
+        return "{} hits, {} misses, {} evictions".format(
+            self.hits, self.misses, self.evictions)
+
+
+class Region(object):
+    """
+    A set of function caches, each bounded to the same number of items.
+
+    Functions decorated with ``cache_on_arguments`` have their results
+    cached in their own ``LRUCache``, keyed on their first argument, and
+    gain ``get(*args)`` and ``set(value, *args)`` methods for reading and
+    writing their cache directly; ``get`` returns ``NO_VALUE`` for a miss.
+    """
+
+    def __init__(self, size=100000):
+        self.size = size
+        self.caches = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, size):
+        self.size = size
+        with self._lock:
+            for cache in self.caches.values():
+                cache.resize(size)
+
+    def cache_on_arguments(self):
+        def decorator(fn):
+            cache = self.caches[fn.__name__] = LRUCache(self.size)
+            lock = self._lock
+
+            def get(*args):
+                key = make_key(args[0])
+                with lock:
+                    return cache.get(key, NO_VALUE)
+
+            def set(value, *args):
+                key = make_key(args[0])
+                with lock:
+                    cache.set(key, value)
+
+            @wraps(fn)
+            def cached(*args):
+                value = get(*args)
+                if value is NO_VALUE:
+                    value = fn(*args)
+                    set(value, *args)
+                return value
+            cached.get = get
+            cached.set = set
+            return cached
+        return decorator
+
+    def invalidate(self):
+        with self._lock:
+            for cache in self.caches.values():
+                cache.clear()
+
+    def stats(self):
+        """Return a line of statistics for each function cache."""
+        return ["{}: {} items, {}".format(name, len(cache), cache.stats())
+                for name, cache in self.caches.items()]
+
+
+def make_key(arg):
+    """
+    Return a stable cache key for ``arg``.
+
+    Strings are used as they are. Anything else is serialized to JSON with
+    sorted keys and hashed, so that equal dicts always have the same key.
+    """
+
+    if isinstance(arg, (type(u''), type(b''))):
+        return arg
+    data = json.dumps(arg, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf-8')).digest()
+
+
+region = Region()
+
+
+class IdentityCache(object):
+    """
+    A persistent cache of identity bitstreams kept in a SQLite database.
+
+    Until it is configured with the path to a database the cache is empty
+    and ignores anything set in it. Bitstreams expire after ``ttl`` seconds.
+    Handles which were not found, which are cached as ``None``, and
+    responses which are not marked as successful expire after
+    ``negative_ttl`` seconds instead so they can be retried sooner.
+    """
+
+    def __init__(self):
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def configure(self, path, ttl=30 * 86400, negative_ttl=86400):
+        self.close()
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._conn = sqlite3.connect(path, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS identities '
+                           '(handle TEXT PRIMARY KEY, data TEXT, '
+                           'expires REAL NOT NULL)')
+
+    def get(self, handle):
+        if self._conn is None:
+            return NO_VALUE
+        with self._lock:
+            row = self._conn.execute('SELECT data, expires FROM identities '
+                                     'WHERE handle = ?', (handle,)).fetchone()
+        if row is None or row[1] < time.time():
+            return NO_VALUE
+        return json.loads(row[0])
+
+    def set(self, handle, data):
+        if self._conn is None:
+            return
+        ttl = self.ttl if data and data.get('success') else \
+            self.negative_ttl
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO identities '
+                               '(handle, data, expires) VALUES (?, ?, ?)',
+                               (handle, json.dumps(data), time.time() + ttl))
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+identities = IdentityCache()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import io
+import json
+import os
+
+from pipeline.readers import (SEGMENT_SIZE, compression, mmap_lines,
+                              open_log, read_ahead, read_segment, segments)
+
+
+try:
+    replace = os.replace
+except AttributeError:
+    replace = os.rename
+
+
+class CheckpointError(Exception):
+    pass
+
+
+class Checkpoint(object):
+    """
+    Record how far a pipeline run has got through each of its input files.
+
+    For every file the byte offset and line number up to which output has
+    been written are kept, along with the path of the identity cache used
+    for the run. The state is saved to a JSON file at ``path``, which is
+    replaced atomically so that a run killed while saving leaves the
+    previous state intact.
+    """
+
+    def __init__(self, path, identity_cache=None):
+        self.path = path
+        self.identity_cache = identity_cache
+        self.files = {}
+
+    @classmethod
+    def load(cls, path):
+        """Load the checkpoint saved at ``path``."""
+        try:
+            with io.open(path, encoding='utf-8') as fp:
+                state = json.load(fp)
+        except (IOError, OSError, ValueError) as e:
+            raise CheckpointError('Could not read checkpoint {}: {}'.format(
+                                  path, e))
+        checkpoint = cls(path, state.get('identity_cache'))
+        checkpoint.files = state.get('files', {})
+        return checkpoint
+
+    def save(self):
+        state = {'identity_cache': self.identity_cache, 'files': self.files}
+        tmp = self.path + '.tmp'
+        with io.open(tmp, 'w', encoding='utf-8') as fp:
+            fp.write(json.dumps(state, indent=2, sort_keys=True))
+            fp.flush()
+            os.fsync(fp.fileno())
+        replace(tmp, self.path)
+
+    def segments(self, files, size=SEGMENT_SIZE, use_mmap=False):
+        """
+        Yield the remaining ``Segment`` objects of ``files`` in order.
+
+        Uncompressed files are split into segments of about ``size`` bytes
+        starting from their recorded offsets. Compressed files can't be
+        read from an offset and are each a single segment.
+        """
+        for path in files:
+            length = os.path.getsize(path)
+            offset = self.files.get(path, {}).get('offset', 0)
+            if offset > length:
+                raise CheckpointError('{} is shorter than its checkpoint '
+                                      'offset {}'.format(path, offset))
+            if offset == length:
+                continue
+            if compression(path):
+                yield Segment(path, 0, length, compressed=True)
+                continue
+            for _, start, end in segments([path], size, offset):
+                yield Segment(path, start, end, use_mmap=use_mmap)
+
+    def advance(self, segment):
+        """Record ``segment`` as written."""
+        progress = self.files.setdefault(segment.path,
+                                         {'offset': 0, 'line': 0})
+        progress['offset'] = segment.end
+        progress['line'] += segment.lines
+
+
+class Segment(object):
+    """
+    The lines between two byte offsets of a log file.
+
+    Once iterated over, ``lines`` is the number of lines in the segment.
+    """
+
+    def __init__(self, path, start, end, compressed=False, use_mmap=False):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.compressed = compressed
+        self.use_mmap = use_mmap
+        self.lines = 0
+
+    def __iter__(self):
+        if self.use_mmap:
+            for line in mmap_lines(self.path, self.start, self.end):
+                yield line
+            self.lines = count_lines(self.path, self.start, self.end)
+            return
+        if self.compressed:
+            lines = read_ahead(open_log(self.path))
+        else:
+            lines = read_segment(self.path, self.start, self.end)
+        self.lines = 0
+        for line in lines:
+            self.lines += 1
+            yield line
+
+
+def count_lines(path, start, end, block=2 ** 20):
+    """Return the number of lines between ``start`` and ``end``."""
+    count = 0
+    data = b''
+    with io.open(path, 'rb') as fp:
+        fp.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            data = fp.read(min(block, remaining))
+            if not data:
+                break
+            count += data.count(b'\n')
+            remaining -= len(data)
+    if data and not data.endswith(b'\n'):
+        count += 1
+    return count
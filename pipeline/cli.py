@@ -1,21 +1,43 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 from contextlib import closing
-import fileinput
+from functools import partial
+import datetime
 import logging
 import logging.config
+import os
 
 import arrow
 import click
-import geoip2.database
-import maxminddb.const
 import pymongo
 import requests
-
-from pipeline.db import engine, metadata
-from pipeline.pipeline import construct_pipeline, to_csv, to_iso_date
-from pipeline.query import get_document
-from pipeline.summary import author_objs, dlc_objs, handle_objs, overall
+from sqlalchemy.sql import select, func
+
+from pipeline.cache import LRUCache, identities, region
+from pipeline.checkpoint import Checkpoint, CheckpointError
+from pipeline.db import engine, requests as requests_table
+from pipeline.follow import Follower, micro_batches
+from pipeline.fused import construct_fused_pipeline
+from pipeline.mongo import SummaryWriter
+from pipeline.parallel import (SummaryError, parse_parallel,
+                               summarize_parallel, summary_shards)
+from pipeline.partitions import (PartitionError, add_months,
+                                 create_partitions, first_of_month,
+                                 is_partitioned, months, truncate_month)
+from pipeline.pipeline import (add_identities, collect_handles,
+                               configure_session, construct_pipeline,
+                               open_reader, prefetch_identities, to_iso_date)
+from pipeline.query import DocumentResolver, resolve_documents
+from pipeline.readers import open_input
+from pipeline.rollup import rebuild
+from pipeline.schema import create_tables, drop_tables
+from pipeline.sink import open_sink
+from pipeline.summary import (author_objs, dlc_objs, handle_objs, overall,
+                              bulk_author_objs, bulk_dlc_objs,
+                              bulk_handle_objs, merge, merged,
+                              get_watermark, set_watermark, rollup_author_objs,
+                              rollup_dlc_objs, rollup_handle_objs,
+                              rollup_overall)
 
 
 logger = logging.getLogger(__name__)
@@ -44,8 +66,15 @@ logging.config.dictConfig({
 
 
 @click.group()
-def main():
-    pass
+@click.option('--verbose', '-v', is_flag=True)
+@click.option('--cache-size', default=100000)
+def main(verbose, cache_size):
+    region.configure(cache_size)
+    if verbose:
+        pipeline_logger = logging.getLogger('pipeline')
+        pipeline_logger.setLevel(logging.INFO)
+        for handler in pipeline_logger.handlers:
+            handler.setLevel(logging.INFO)
 
 
 @main.command()
@@ -56,22 +85,64 @@ def main():
 @click.option('--geo-ip', default='GeoLite2-Country.mmdb',
               type=click.Path(exists=True, resolve_path=True))
 @click.option('--dspace', default='https://dspace.mit.edu/ws/oastats')
+@click.option('--dspace-concurrency', default=1)
+@click.option('--dspace-retries', default=3)
+@click.option('--dspace-backoff', default=0.5)
+@click.option('--identity-cache', type=click.Path(dir_okay=False))
+@click.option('--identity-ttl', default=30.0)
+@click.option('--identity-negative-ttl', default=1.0)
+@click.option('--prefetch', is_flag=True)
+@click.option('--preload', is_flag=True)
 @click.option('--database', envvar='OASTATS_DATABASE')
-def pipeline(files, month, geo_ip, dspace, database):
+@click.option('--sink', default='csv',
+              type=click.Choice(['csv', 'copy', 'insert']))
+@click.option('--commit-every', default=10000)
+@click.option('--rollups', is_flag=True)
+@click.option('--workers', '-w', default=1)
+@click.option('--engine', 'engine_name', default='compose',
+              type=click.Choice(['compose', 'fused']))
+@click.option('--geo-cache-size', default=65536)
+@click.option('--geo-reader', default='geoip2',
+              type=click.Choice(['geoip2', 'maxminddb']))
+@click.option('--log-reader', default='fileinput',
+              type=click.Choice(['fileinput', 'mmap']))
+@click.option('--checkpoint', type=click.Path(dir_okay=False))
+@click.option('--checkpoint-size', default=64.0)
+@click.option('--resume', is_flag=True)
+def pipeline(files, month, geo_ip, dspace, dspace_concurrency, dspace_retries,
+             dspace_backoff, identity_cache, identity_ttl,
+             identity_negative_ttl, prefetch, preload, database, sink,
+             commit_every, rollups, workers, engine_name, geo_cache_size,
+             geo_reader, log_reader, checkpoint, checkpoint_size, resume):
     """
     Process the Apache logs and populate the database with identities.
 
     This command will process the logs and print the output to STDOUT. The
     output format is CSV suitable for passing to PostGres's COPY command.
     The field order is: status, country, url, referer, user_agent, datetime,
-    document_id. Any requests which could not be processed due to malformed
+    document_id. If the database was created with ``db create
+    --normalized``, the country, referer and user_agent fields are replaced
+    by their ids. Any requests which could not be processed due to malformed
     log entries will be logged to STDERR.
 
+    With ``--sink copy`` the requests are instead loaded straight into the
+    ``requests`` table of a PostGres database using ``COPY``, committing
+    every ``--commit-every`` requests. Other databases can be loaded with
+    ``--sink insert``, which uses multi-row inserts. Add ``--rollups`` to
+    either of these to also keep the daily rollup tables up to date as the
+    requests are loaded (see the ``rollup`` command).
+
     IP addresses are converted to three letter country codes using the
     `GeoLite2 country database
     <http://dev.maxmind.com/geoip/geoip2/geolite2/>`_. Make sure to use the
     binary format (``.mmdb``) and that it's current; these are updated
     regularly. Pass the location of this file using the ``--geo-ip`` option.
+    The most recently seen IP addresses are cached; the number kept can be
+    set with ``--geo-cache-size``, and ``0`` disables the cache. Pass
+    ``--verbose/-v`` before the subcommand to log the number of cache hits
+    and misses when the pipeline finishes. Use ``--geo-reader maxminddb``
+    to read the country codes directly from the database records instead
+    of through ``geoip2``, which is considerably faster.
 
     The pipeline can filter for log entries by date. Use the ``--month/-m``
     option to specify a month to select. This can be repeated as many times
@@ -80,7 +151,42 @@ def pipeline(files, month, geo_ip, dspace, database):
     If no month is provided all log entries will be processed.
 
     Identity data is collected from a custom Dspace identity bitstream. This
-    can be specified using the ``--dspace`` option.
+    can be specified using the ``--dspace`` option. Use
+    ``--dspace-concurrency`` to look up several handles at once; the
+    requests are read ahead so that lookups overlap, but are still output in
+    their original order. Failed lookups are retried ``--dspace-retries``
+    times, waiting ``--dspace-backoff`` seconds and then exponentially
+    longer between attempts.
+
+    Identity data can be kept between runs by passing the path to a cache
+    file with ``--identity-cache``; it will be created if it doesn't exist.
+    Cached identities expire after ``--identity-ttl`` days, while handles
+    which DSpace could not find, or did not return a successful response
+    for, are retried after ``--identity-negative-ttl`` days. Lookups which
+    failed with a server error are retried on the next run. Within a run, identities, documents, authors and DLCs are each
+    cached in memory, keeping up to the number of items given by
+    ``oastats --cache-size``; their hits, misses and evictions are logged
+    at the end with ``--verbose/-v``.
+
+    With the ``--prefetch`` flag, the logs are first scanned for the handles
+    that were requested, and their identities are all looked up, using
+    ``--dspace-concurrency`` lookups at a time, before the logs are
+    processed. Progress is shown on STDERR. This cannot be used when
+    reading from STDIN.
+
+    Document ids are resolved against the database in chunks of requests.
+    The ``--preload`` flag will instead load the ids of every document,
+    author and DLC at startup, after which only new ones hit the database.
+
+    Parsing the log entries and looking up their countries can be spread
+    over several processes with the ``--workers/-w`` option. Log files are
+    split into segments which are parsed in parallel, while identities and
+    documents are still resolved in order by the main process. The output
+    is the same regardless of the number of workers.
+
+    By default, each stage of the pipeline is a separate generator. Use
+    ``--engine fused`` to instead run every stage in a single loop over the
+    lines, which produces the same output with less overhead per line.
 
     The path to one or more log files should be passed as arguments to the
     pipeline. For example::
@@ -93,32 +199,196 @@ def pipeline(files, month, geo_ip, dspace, database):
             url, referer, user_agent, datetime, document_id) FROM STDIN \\
             WITH CSV" < output.csv
 
+    Log files compressed with gzip, bzip2, xz or zstandard (if the
+    ``zstandard`` package is installed) are decompressed as they are read,
+    in a background thread which reads ahead of the pipeline. Uncompressed
+    log files can be read with ``--log-reader mmap``, which memory maps
+    them and only decodes the lines for Open Access downloads.
+
+    Long runs can be made resumable by passing the path to a state file
+    with ``--checkpoint``. The log files are then processed in segments of
+    about ``--checkpoint-size`` megabytes (compressed files are a single
+    segment). After the output for each segment has been written, or
+    committed with ``--sink copy`` or ``insert``, the byte offset and line
+    number reached in each file are saved to the state file. Identities are
+    kept in the ``--identity-cache``, or in a cache next to the state file
+    if none is given. If the run fails, rerun the same command with
+    ``--resume`` to carry on from the last saved segment, appending to the
+    existing output. Checkpoints cannot be used with STDIN or
+    ``--workers``.
     """
 
+    if prefetch and (not files or '-' in files):
+        raise click.UsageError('--prefetch cannot be used with STDIN')
+    if resume and not checkpoint:
+        raise click.UsageError('--resume requires --checkpoint')
+    if checkpoint and (not files or '-' in files):
+        raise click.UsageError('--checkpoint cannot be used with STDIN')
+    if checkpoint and workers > 1:
+        raise click.UsageError('--checkpoint cannot be used with --workers')
+    state = None
+    if checkpoint:
+        try:
+            state = Checkpoint.load(checkpoint) if resume else \
+                Checkpoint(checkpoint, checkpoint + '.identities')
+            state.identity_cache = identity_cache or state.identity_cache
+            identity_cache = state.identity_cache
+            remaining = list(state.segments(files,
+                                            int(checkpoint_size * 2 ** 20),
+                                            log_reader == 'mmap'))
+        except CheckpointError as e:
+            raise click.ClickException(str(e))
     if not month:
         month = []
     dates = [arrow.get(d, ['MMM/YYYY', 'MMM-YYYY']) for d in month]
     dates = [d.format('MMM/YYYY') for d in dates]
+    countries = LRUCache(geo_cache_size) if geo_cache_size else None
+    raw = geo_reader == 'maxminddb'
+    use_mmap = log_reader == 'mmap'
+    engine.configure(database)
+    check_sink(sink, rollups)
+    if identity_cache:
+        identities.configure(identity_cache, identity_ttl * 86400,
+                             identity_negative_ttl * 86400)
+    with closing(identities), requests.Session() as session:
+        configure_session(session, dspace_concurrency, dspace_retries,
+                          dspace_backoff)
+        if prefetch:
+            handles = collect_handles(open_input(files, use_mmap), dates)
+            fetched = prefetch_identities(handles, dspace, session,
+                                          dspace_concurrency)
+            with click.progressbar(fetched, length=len(handles),
+                                   label='Fetching identities',
+                                   file=click.get_text_stream('stderr')) \
+                    as progress:
+                for _ in progress:
+                    pass
+        with closing(open_reader(geo_ip, raw)) as reader:
+            with closing(engine().connect()) as conn:
+                if workers > 1:
+                    parsed = parse_parallel(files, geo_ip, dates, workers,
+                                            engine=engine_name,
+                                            cache=countries, raw=raw,
+                                            use_mmap=use_mmap)
+                    reqs = add_identities(parsed, dspace, session,
+                                          dspace_concurrency)
+                else:
+                    construct = construct_pipeline
+                    if engine_name == 'fused':
+                        construct = construct_fused_pipeline
+                    pipeline = construct(session, reader, dspace, dates,
+                                         countries, dspace_concurrency)
+                    if state is None:
+                        reqs = pipeline(open_input(files, use_mmap))
+                resolver = DocumentResolver(conn)
+                if preload:
+                    resolver.preload()
+                if state is None:
+                    with open_sink(sink, engine(), commit_every,
+                                   rollups) as output:
+                        write_requests(reqs, resolver, output)
+                else:
+                    with open_sink(sink, engine(), 0, rollups) as output:
+                        for segment in remaining:
+                            write_requests(pipeline(segment), resolver,
+                                           output)
+                            output.flush()
+                            state.advance(segment)
+                            state.save()
+    if countries is not None:
+        logger.info("Country cache: {}".format(countries.stats()))
+    log_cache_stats()
+
+
+@main.command()
+@click.argument('files', nargs=-1, required=True,
+                type=click.Path(exists=True, dir_okay=False,
+                                resolve_path=True))
+@click.option('--geo-ip', default='GeoLite2-Country.mmdb',
+              type=click.Path(exists=True, resolve_path=True))
+@click.option('--dspace', default='https://dspace.mit.edu/ws/oastats')
+@click.option('--dspace-concurrency', default=1)
+@click.option('--dspace-retries', default=3)
+@click.option('--dspace-backoff', default=0.5)
+@click.option('--identity-cache', type=click.Path(dir_okay=False))
+@click.option('--database', envvar='OASTATS_DATABASE')
+@click.option('--state', type=click.Path(dir_okay=False))
+@click.option('--batch-size', default=1000)
+@click.option('--latency', default=5.0)
+@click.option('--interval', default=1.0)
+@click.option('--once', is_flag=True)
+@click.option('--rollups', is_flag=True)
+def follow(files, geo_ip, dspace, dspace_concurrency, dspace_retries,
+           dspace_backoff, identity_cache, database, state, batch_size,
+           latency, interval, once, rollups):
+    """
+    Continuously load new requests from live Apache logs.
+
+    Each of the log files is followed, like ``tail -F``, and new log entries
+    are run through the same stages as the ``pipeline`` command and
+    inserted straight into the ``requests`` table (using ``COPY`` on
+    PostGres). Log files which are rotated are followed to their new file
+    once the old one has been read, and truncated files are read again from
+    the beginning.
+
+    New entries are collected into batches which are loaded once they have
+    ``--batch-size`` entries or have been waiting for ``--latency`` seconds.
+    The files are checked every ``--interval`` seconds while there is
+    nothing new. Pass the path to a state file with ``--state`` to record
+    how far through each file has been loaded after every batch; when this
+    command is restarted with the same state file it will carry on from
+    where it left off. With ``--once``, everything in the files at the time
+    is loaded and then the command exits, which can be useful when run
+    from cron. Otherwise it runs until it is interrupted. For example::
+
+        \b
+        (oastats)$ oastats follow --state follow.json \\
+            --geo-ip data/GeoLite2.mmdb /var/log/apache2/access.log
+
+    The ``--dspace``, ``--identity-cache`` and ``--rollups`` options work
+    as they do for the ``pipeline`` command.
+    """
+
     engine.configure(database)
-    with requests.Session() as session:
-        with closing(geoip2.database.Reader(geo_ip,
-                     mode=maxminddb.const.MODE_MMAP)) as reader:
+    checkpoint = None
+    if state:
+        try:
+            checkpoint = Checkpoint.load(state) if os.path.exists(state) \
+                else Checkpoint(state)
+        except CheckpointError as e:
+            raise click.ClickException(str(e))
+    progress = checkpoint.files if checkpoint is not None else {}
+    followers = [Follower(f, **progress.get(f, {})) for f in files]
+    kind = 'copy' if engine().dialect.name == 'postgresql' else 'insert'
+    if identity_cache:
+        identities.configure(identity_cache)
+    with closing(identities), requests.Session() as session:
+        configure_session(session, dspace_concurrency, dspace_retries,
+                          dspace_backoff)
+        with closing(open_reader(geo_ip)) as reader:
             with closing(engine().connect()) as conn:
-                pipeline = construct_pipeline(session, reader, dspace, dates)
-                for request in pipeline(fileinput.input(files)):
-                    doc_id = get_document(request['handle'],
-                                          request['title'],
-                                          request.get('authors', []),
-                                          request.get('dlcs', []),
-                                          conn)
-                    req = (request['status'],
-                           request['country'],
-                           request['request_url'],
-                           request.get('referer', ''),
-                           request.get('user_agent', ''),
-                           request['time'],
-                           str(doc_id))
-                    click.echo(to_csv(req))
+                pipeline = construct_pipeline(session, reader, dspace, [],
+                                              LRUCache(65536),
+                                              dspace_concurrency)
+                resolver = DocumentResolver(conn)
+                resolver.preload()
+                batches = micro_batches(followers, batch_size, latency,
+                                        interval, once)
+                try:
+                    with open_sink(kind, engine(), 0, rollups) as output:
+                        for batch in batches:
+                            count = write_requests(pipeline(batch),
+                                                   resolver, output)
+                            output.flush()
+                            if checkpoint is not None:
+                                save_progress(checkpoint, followers)
+                            logger.info("Loaded {} of {} log entries".format(
+                                        count, len(batch)))
+                except KeyboardInterrupt:
+                    pass
+    for follower in followers:
+        follower.close()
+    log_cache_stats()
 
 
 @main.command()
@@ -126,7 +396,14 @@ def pipeline(files, month, geo_ip, dspace, database):
 @click.option('--mongo', default='mongodb://localhost:27017')
 @click.option('--mongo-db', default='oastats')
 @click.option('--mongo-coll', default='summary')
-def summary(database, mongo, mongo_db, mongo_coll):
+@click.option('--bulk', is_flag=True)
+@click.option('--incremental', is_flag=True)
+@click.option('--rollups', is_flag=True)
+@click.option('--batch-size', default=1000)
+@click.option('--swap', is_flag=True)
+@click.option('--jobs', '-j', default=1)
+def summary(database, mongo, mongo_db, mongo_coll, bulk, incremental,
+            rollups, batch_size, swap, jobs):
     """
     Create the summary collection in Mongo.
 
@@ -134,37 +411,144 @@ def summary(database, mongo, mongo_db, mongo_coll):
     effectively functions as a pregenerated query cache. This command will
     generate and insert the necessary JSON objects into Mongo.
 
-    Though not required, it is recommended to create a temporary summary
-    collection in Mongo and rename it to ``summary`` once this command has
-    finished. For example::
+    Summary objects are upserted into the collection in batches, the size
+    of which can be set with ``--batch-size``. Though not required, it is
+    recommended to use the ``--swap`` flag when regenerating the whole
+    summary. This will insert the objects into a temporary collection
+    (the name of the collection with ``_new`` appended) and rename it to
+    replace the existing collection once this command has finished. For
+    example::
 
         \b
-        (oastats)$ oastats summary --mongo-coll summary_new
-        (oastats)$ mongo oastats --eval \\
-            'db.summary_new.renameCollection("summary", true)'
+        (oastats)$ oastats summary --bulk --swap
+
+    By default, each author, DLC and handle is summarized with its own set
+    of queries. On large databases, use the ``--bulk`` flag to instead
+    compute the counts for all of them in a few grouped queries which are
+    streamed into the same summary objects.
+
+    Each run records the id of the last request it summarized. With the
+    ``--incremental`` flag, only the authors, DLCs and handles with newer
+    requests are summarized and their new counts are added to the objects
+    already in the collection. If the collection has not been summarized
+    before a full summary is generated instead. Incremental summaries
+    should be written to the collection that is being updated, and should
+    not be run while requests are being loaded, and cannot be combined with
+    ``--swap``.
+
+    If the requests were loaded with ``--rollups``, or the rollup tables
+    have been built with the ``rollup`` command, use the ``--rollups`` flag
+    to read the counts from the much smaller daily rollup tables instead of
+    the ``requests`` table. This cannot be combined with ``--incremental``.
+
+    The per entity summaries can be split between several processes with
+    ``--jobs``. The authors, DLCs and handles are divided into shards which
+    are summarized by a pool of that many processes, each with its own
+    database and Mongo connections, while a progress bar is shown on
+    STDERR. If any shard fails the command stops with the error from the
+    worker; with ``--swap`` the existing collection is left untouched.
+    ``--jobs`` cannot be combined with ``--bulk``, ``--incremental`` or
+    ``--rollups``. For example::
+
+        \b
+        (oastats)$ oastats summary --jobs 8 --swap
     """
 
+    if incremental and swap:
+        raise click.UsageError('--incremental cannot be used with --swap')
+    if incremental and rollups:
+        raise click.UsageError('--incremental cannot be used with --rollups')
+    if jobs > 1 and (bulk or incremental or rollups):
+        raise click.UsageError('--jobs cannot be used with --bulk, '
+                               '--incremental or --rollups')
     engine.configure(database)
     client = pymongo.MongoClient(mongo)
     collection = client[mongo_db][mongo_coll]
+    target = '{}.{}'.format(mongo_db, mongo_coll)
+    with closing(engine().connect()) as conn:
+        until, latest = conn.execute(
+            select([func.max(requests_table.c.id),
+                    func.max(requests_table.c.datetime)])).first()
+        since = get_watermark(conn, target) if incremental else None
+        if since is not None and since == until:
+            logger.info("No new requests since {}".format(since))
+            return
+        if rollups:
+            window = {}
+            summaries = (rollup_author_objs, rollup_dlc_objs,
+                         rollup_handle_objs)
+        elif bulk or since is not None:
+            window = {'since': since, 'until': until}
+            summaries = [partial(s, **window) for s in
+                         (bulk_author_objs, bulk_dlc_objs, bulk_handle_objs)]
+        else:
+            window = {}
+            summaries = (author_objs, dlc_objs, handle_objs)
+        with SummaryWriter(collection, batch_size, swap) as writer:
+            if jobs > 1:
+                summarize_jobs(conn, database, mongo, mongo_db,
+                               writer.collection.name, jobs, batch_size)
+            else:
+                for summary_objs in summaries:
+                    objs = summary_objs(conn)
+                    if since is not None:
+                        objs = merged(collection, objs)
+                    for obj in objs:
+                        writer.write(obj)
+            totals = rollup_overall(conn) if rollups else \
+                overall(conn, **window)
+            if since is not None:
+                totals = merge(collection.find_one({'_id': 'Overall'}),
+                               totals)
+            totals['_id'] = 'Overall'
+            writer.write(totals)
+        if until is not None:
+            set_watermark(conn, target, until, latest)
+
+
+@main.command()
+@click.option('--database', envvar='OASTATS_DATABASE')
+@click.option('--start')
+@click.option('--end')
+def rollup(database, start, end):
+    """
+    Rebuild the daily rollup tables from the requests.
+
+    The ``document_downloads``, ``author_downloads`` and ``dlc_downloads``
+    tables hold the number of downloads of each document, author and DLC
+    per day and country. They are kept up to date while requests are loaded
+    with the ``--rollups`` flag, and are read by ``summary --rollups``.
+
+    This command recounts them from the ``requests`` table, which is needed
+    once after upgrading an existing database or after requests have been
+    loaded without ``--rollups``. Only the days from ``--start`` up to, but
+    not including, ``--end`` (both ``YYYY-MM-DD``) are rebuilt if either is
+    given. For example::
+
+        \b
+        (oastats)$ oastats rollup --start 2016-01-01 --end 2016-02-01
+    """
+
+    try:
+        start, end = [arrow.get(d, 'YYYY-MM-DD').date() if d else None
+                      for d in (start, end)]
+    except (arrow.parser.ParserError, ValueError) as e:
+        raise click.BadParameter(str(e))
+    engine.configure(database)
     with closing(engine().connect()) as conn:
-        for author in author_objs(conn):
-            collection.update_one({'_id': author['_id']},
-                                  {'$set': author}, upsert=True)
-        for dlc in dlc_objs(conn):
-            collection.update_one({'_id': dlc['_id']},
-                                  {'$set': dlc}, upsert=True)
-        for handle in handle_objs(conn):
-            collection.update_one({'_id': handle['_id']},
-                                  {'$set': handle}, upsert=True)
-        collection.update_one({'_id': 'Overall'},
-                              {'$set': overall(conn)}, upsert=True)
+        rebuild(conn, start, end)
 
 
 @main.command()
-@click.argument('command', type=click.Choice(['create', 'drop']))
+@click.argument('command', type=click.Choice(['create', 'drop', 'partition',
+                                              'truncate']))
 @click.option('--database', envvar='OASTATS_DATABASE')
-def db(command, database):
+@click.option('--partitioned', is_flag=True)
+@click.option('--normalized', is_flag=True)
+@click.option('--start')
+@click.option('--ahead', default=3)
+@click.option('--month')
+def db(command, database, partitioned, normalized, start, ahead, month):
     """
     Create/drop the PostGres database tables.
 
@@ -176,14 +560,83 @@ def db(command, database):
 
         (oastats)$ oastats db create
 
+    With ``--partitioned``, the ``requests`` table is instead created with
+    a partition for each month of requests, which makes reloading a month
+    much cheaper. Partitions are created from the month given by
+    ``--start`` (``YYYY-MM``, the current month by default) until
+    ``--ahead`` months from now. Requests loaded straight into the database
+    get the partitions for their months created as needed, but running the
+    ``partition`` command regularly, for example from cron, makes sure the
+    upcoming partitions exist before they are used::
+
+        \b
+        (oastats)$ oastats db create --partitioned --start 2010-01
+        (oastats)$ oastats db partition --ahead 3
+
+    The ``truncate`` command removes all the requests for the ``--month``
+    given, along with their counts in the rollup tables, so that the month
+    can be loaded again. On a partitioned table this truncates the month's
+    partition; otherwise the requests are deleted. The summary collection
+    should be regenerated afterwards::
+
+        \b
+        (oastats)$ oastats db truncate --month 2016-01
+
+    With ``--normalized``, the requests are instead stored in a
+    ``request_facts`` table which has the ids of their country, referer and
+    user agent in place of the values themselves, which makes the table and
+    its indexes much smaller. The values are kept in the ``countries``,
+    ``referers`` and ``user_agents`` tables, and a ``requests`` view joins
+    them back together for querying. Requests loaded into the database are
+    encoded as needed, and the CSV output of the ``pipeline`` command
+    follows the layout of ``request_facts`` so that it can be loaded with::
+
+        \b
+        (oastats)$ psql oastats -c "COPY request_facts (status, country_id,
+            url, referer_id, user_agent_id, datetime, document_id)
+            FROM STDIN WITH CSV" < requests.csv
+
+    ``--normalized`` can be combined with ``--partitioned``.
     """
 
+    try:
+        start, month = [arrow.get(d, 'YYYY-MM').date() if d else None
+                        for d in (start, month)]
+    except (arrow.parser.ParserError, ValueError) as e:
+        raise click.BadParameter(str(e))
     engine.configure(database)
+    this_month = first_of_month(datetime.date.today())
+    upcoming = months(start or this_month, add_months(this_month, ahead))
+    if partitioned or command == 'partition':
+        if engine().dialect.name != 'postgresql':
+            raise click.UsageError('Partitions require a PostGres database')
     if command == 'create':
-        metadata.create_all(engine())
+        with closing(engine().connect()) as conn:
+            create_tables(conn, partitioned, normalized)
+            if partitioned:
+                with conn.begin():
+                    create_partitions(conn, upcoming)
     elif command == 'drop':
         if click.confirm('Are you sure you want to drop the database?'):
-            metadata.drop_all(engine())
+            with closing(engine().connect()) as conn:
+                drop_tables(conn)
+    elif command == 'partition':
+        with closing(engine().connect()) as conn:
+            if not is_partitioned(conn):
+                raise click.ClickException('The requests table is not '
+                                           'partitioned')
+            with conn.begin():
+                create_partitions(conn, upcoming)
+    elif command == 'truncate':
+        if month is None:
+            raise click.UsageError('truncate requires --month')
+        if click.confirm('Are you sure you want to remove the requests for '
+                         '{}?'.format(month.strftime('%Y-%m'))):
+            with closing(engine().connect()) as conn:
+                try:
+                    truncate_month(conn, month)
+                except PartitionError as e:
+                    raise click.ClickException(str(e))
 
 
 @main.command()
@@ -191,7 +644,13 @@ def db(command, database):
 @click.option('--mongo', default='mongodb://localhost:27017')
 @click.option('--mongo-db', default='oastats')
 @click.option('--mongo-coll', default='requests')
-def load(database, mongo, mongo_db, mongo_coll):
+@click.option('--preload', is_flag=True)
+@click.option('--sink', default='csv',
+              type=click.Choice(['csv', 'copy', 'insert']))
+@click.option('--commit-every', default=10000)
+@click.option('--rollups', is_flag=True)
+def load(database, mongo, mongo_db, mongo_coll, preload, sink, commit_every,
+         rollups):
     """
     Load the Mongo requests collection into PostGres.
 
@@ -207,24 +666,74 @@ def load(database, mongo, mongo_db, mongo_coll):
             "db.requests.createIndex({time: -1})"
         (oastats)$ oastats load
 
+    The ``--preload``, ``--sink``, ``--commit-every`` and ``--rollups``
+    options work as they do for the ``pipeline`` command.
     """
 
     engine.configure(database)
+    check_sink(sink, rollups)
     client = pymongo.MongoClient(mongo)
     collection = client[mongo_db][mongo_coll]
     with closing(engine().connect()) as conn:
-        for request in collection.find().sort('time',
-                                              pymongo.DESCENDING):
-            doc_id = get_document(request['handle'],
-                                  request['title'],
-                                  request.get('authors', []),
-                                  request.get('dlcs', []),
-                                  conn)
-            req = (request['status'],
-                   request['country'],
-                   request['request'],
-                   request.get('referer', ''),
-                   request.get('user_agent', ''),
-                   request['time'].isoformat(),
-                   str(doc_id))
-            click.echo(to_csv(req))
+        reqs = collection.find().sort('time', pymongo.DESCENDING)
+        resolver = DocumentResolver(conn)
+        if preload:
+            resolver.preload()
+        with open_sink(sink, engine(), commit_every, rollups) as output:
+            for request, doc_id in resolve_documents(reqs, resolver):
+                output.write((request['status'],
+                              request['country'],
+                              request['request'],
+                              request.get('referer', ''),
+                              request.get('user_agent', ''),
+                              request['time'].isoformat(),
+                              str(doc_id)))
+    log_cache_stats()
+
+
+def write_requests(reqs, resolver, output):
+    count = 0
+    for request, doc_id in resolve_documents(reqs, resolver):
+        count += 1
+        output.write((request['status'],
+                      request['country'],
+                      request['request_url'],
+                      request.get('referer', ''),
+                      request.get('user_agent', ''),
+                      request['time'],
+                      str(doc_id)))
+    return count
+
+
+def save_progress(checkpoint, followers):
+    for f in followers:
+        checkpoint.files[f.path] = {'offset': f.offset, 'line': f.line,
+                                    'inode': f.inode}
+    checkpoint.save()
+
+
+def log_cache_stats():
+    for line in region.stats():
+        logger.info("Function cache {}".format(line))
+
+
+def check_sink(sink, rollups=False):
+    if sink == 'copy' and engine().dialect.name != 'postgresql':
+        raise click.UsageError('--sink copy requires a PostGres database')
+    if rollups and sink == 'csv':
+        raise click.UsageError('--rollups requires --sink copy or insert')
+
+
+def summarize_jobs(conn, database, mongo, mongo_db, mongo_coll, jobs,
+                   batch_size):
+    shards = summary_shards(conn)
+    done = summarize_parallel(shards, database, mongo, mongo_db, mongo_coll,
+                              jobs, batch_size)
+    with click.progressbar(length=sum(len(ids) for _, ids in shards),
+                           label='Summarizing',
+                           file=click.get_text_stream('stderr')) as progress:
+        try:
+            for count in done:
+                progress.update(count)
+        except SummaryError as e:
+            raise click.ClickException(str(e))
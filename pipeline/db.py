@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
+import hashlib
 
-from sqlalchemy import (Table, Column, Integer, String, MetaData, ForeignKey,
-                        DateTime, Index, create_engine)
+from sqlalchemy import (Table, Column, Integer, SmallInteger, String,
+                        MetaData, ForeignKey, Date, DateTime, Index,
+                        create_engine)
 
 
 metadata = MetaData()
@@ -66,9 +68,121 @@ requests = Table('requests', metadata,
                  Column('datetime', DateTime),
                  Column('document_id', Integer, ForeignKey('documents.id'),
                         nullable=False, index=True),
+                 Index('idx_requests_datetime', 'datetime',
+                       postgresql_using='brin'),
                  )
 
 
+summary_watermarks = Table('summary_watermarks', metadata,
+                           Column('id', Integer, primary_key=True),
+                           Column('collection', String, unique=True,
+                                  nullable=False),
+                           Column('request_id', Integer, nullable=False),
+                           Column('datetime', DateTime),
+                           )
+
+
+document_downloads = Table('document_downloads', metadata,
+                           Column('id', Integer, primary_key=True),
+                           Column('document_id', Integer,
+                                  ForeignKey('documents.id'), nullable=False),
+                           Column('date', Date, nullable=False),
+                           Column('country', String(3), nullable=False),
+                           Column('downloads', Integer, nullable=False),
+                           Index('idx_document_downloads', 'document_id',
+                                 'date', 'country', unique=True)
+                           )
+
+
+author_downloads = Table('author_downloads', metadata,
+                         Column('id', Integer, primary_key=True),
+                         Column('author_id', Integer,
+                                ForeignKey('authors.id'), nullable=False),
+                         Column('date', Date, nullable=False),
+                         Column('country', String(3), nullable=False),
+                         Column('downloads', Integer, nullable=False),
+                         Index('idx_author_downloads', 'author_id', 'date',
+                               'country', unique=True)
+                         )
+
+
+dlc_downloads = Table('dlc_downloads', metadata,
+                      Column('id', Integer, primary_key=True),
+                      Column('dlc_id', Integer, ForeignKey('dlcs.id'),
+                             nullable=False),
+                      Column('date', Date, nullable=False),
+                      Column('country', String(3), nullable=False),
+                      Column('downloads', Integer, nullable=False),
+                      Index('idx_dlc_downloads', 'dlc_id', 'date', 'country',
+                            unique=True)
+                      )
+
+
+# The normalized schema stores requests in ``request_facts``, with the
+# country, referer and user agent replaced by ids in lookup tables.
+# ``requests`` is then a view joining them back together. Referers and user
+# agents can be longer than PostGres can index, so they are unique on the
+# md5 of the value in their ``hash`` column instead (see ``value_hash``).
+normalized_metadata = MetaData()
+
+
+countries = Table('countries', normalized_metadata,
+                  Column('id', SmallInteger().with_variant(Integer, 'sqlite'),
+                         primary_key=True),
+                  Column('code', String(3), unique=True, nullable=False),
+                  )
+
+
+referers = Table('referers', normalized_metadata,
+                 Column('id', Integer, primary_key=True),
+                 Column('hash', String(32), unique=True, nullable=False),
+                 Column('referer', String, nullable=False),
+                 )
+
+
+user_agents = Table('user_agents', normalized_metadata,
+                    Column('id', Integer, primary_key=True),
+                    Column('hash', String(32), unique=True, nullable=False),
+                    Column('user_agent', String, nullable=False),
+                    )
+
+
+request_facts = Table('request_facts', normalized_metadata,
+                      Column('id', Integer, primary_key=True),
+                      Column('status', SmallInteger),
+                      Column('country_id', SmallInteger,
+                             ForeignKey('countries.id')),
+                      Column('url', String),
+                      Column('referer_id', Integer,
+                             ForeignKey('referers.id')),
+                      Column('user_agent_id', Integer,
+                             ForeignKey('user_agents.id')),
+                      Column('datetime', DateTime),
+                      Column('document_id', Integer,
+                             ForeignKey(documents.c.id), nullable=False,
+                             index=True),
+                      Index('idx_request_facts_datetime', 'datetime',
+                            postgresql_using='brin'),
+                      )
+
+
+def value_hash(value):
+    """Return the ``hash`` column value for a referer or user agent."""
+    return hashlib.md5(value.encode('utf-8')).hexdigest()
+
+
+def request_table(conn):
+    """
+    Return the table requests are stored in.
+
+    This is ``request_facts`` in the normalized schema and ``requests``
+    otherwise.
+    """
+    if conn.dialect.has_table(conn, request_facts.name):
+        return request_facts
+    return requests
+
+
 class Engine(object):
     def __init__(self):
         self._engine = None
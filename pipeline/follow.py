@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import io
+import logging
+import os
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class Follower(object):
+    """
+    Read the lines appended to a log file, following it when it's rotated.
+
+    Each call to ``read`` returns the complete lines written since the last
+    call. A partial line at the end of the file is held back until the rest
+    of it arrives. Once the file at ``path`` is replaced by a new one (it
+    has a different inode) the rest of the old file is read and then the
+    new file is followed from its beginning. If the file is truncated it is
+    read again from the beginning.
+
+    ``offset`` and ``line`` are the byte offset and line number just after
+    the last line returned; ``inode`` identifies the file they refer to.
+    Starting from a saved ``offset`` only applies to the file with the
+    same ``inode``.
+    """
+
+    def __init__(self, path, offset=0, line=0, inode=None, block=2 ** 20):
+        self.path = path
+        self.offset = offset
+        self.line = line
+        self.inode = inode
+        self.block = block
+        self._fp = None
+        self._partial = b''
+
+    def read(self):
+        if self._fp is None and not self._open():
+            return []
+        lines, eof = self._read()
+        if not eof:
+            return lines
+        try:
+            stat = os.stat(self.path)
+        except (IOError, OSError):
+            return lines
+        if stat.st_ino != self.inode:
+            logger.info("{} was rotated".format(self.path))
+            self.close()
+            if self._open():
+                lines.extend(self._read()[0])
+        elif stat.st_size < self._fp.tell():
+            logger.info("{} was truncated".format(self.path))
+            self._fp.seek(0)
+            self.offset = self.line = 0
+            self._partial = b''
+            lines.extend(self._read()[0])
+        return lines
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+        self._partial = b''
+
+    def _open(self):
+        try:
+            self._fp = io.open(self.path, 'rb')
+        except (IOError, OSError):
+            return False
+        stat = os.fstat(self._fp.fileno())
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            self.offset = self.line = 0
+        self.inode = stat.st_ino
+        self._fp.seek(self.offset)
+        return True
+
+    def _read(self):
+        chunk = self._fp.read(self.block)
+        data = self._partial + chunk
+        end = data.rfind(b'\n') + 1
+        self._partial = data[end:]
+        lines = data[:end].splitlines(True)
+        self.offset += end
+        self.line += len(lines)
+        return ([l.decode('utf-8', 'replace') for l in lines],
+                len(chunk) < self.block)
+
+
+def micro_batches(followers, size=1000, latency=5.0, interval=1.0,
+                  once=False):
+    """
+    Yield lists of the new lines from ``followers``.
+
+    A batch is yielded once it has ``size`` lines or ``latency`` seconds
+    after its first line arrived, whichever comes first. The followers are
+    polled every ``interval`` seconds while there is nothing new. With
+    ``once``, the lines already in the files are yielded and then this
+    stops instead of waiting for more.
+    """
+
+    batch = []
+    started = None
+    while True:
+        lines = []
+        for follower in followers:
+            lines.extend(follower.read())
+        if lines:
+            batch.extend(lines)
+            started = started or time.time()
+        if batch and (len(batch) >= size or (once and not lines) or
+                      time.time() - started >= latency):
+            yield batch
+            batch = []
+            started = None
+        elif once and not lines:
+            return
+        elif not lines:
+            time.sleep(interval)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import logging
+import re
+
+import arrow
+
+from pipeline.pipeline import (bots_contain, bots_startswith, excluded_ips,
+                               fetch_identities, field_names, lookup_country,
+                               pattern, to_iso_date)
+
+
+logger = logging.getLogger(__name__)
+
+
+class Request(object):
+    """
+    A parsed log entry.
+
+    Fields are stored in slots rather than in a dict for each request. Item
+    access and ``get`` are supported so a request can be used anywhere the
+    dicts produced by ``parse_into_dict`` are.
+    """
+
+    __slots__ = field_names + ('country', 'handle', 'title', 'authors',
+                               'dlcs')
+
+    def __init__(self, values):
+        (self.remote_host, self.remote_logname, self.remote_user, self.time,
+         self.request_method, self.request_url, self.request_http_version,
+         self.status, self.bytes, self.referer, self.user_agent) = values
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __getstate__(self):
+        return self.as_dict()
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def as_dict(self):
+        return dict((k, getattr(self, k)) for k in self.__slots__
+                    if hasattr(self, k))
+
+
+def construct_fused_parser(reader, dates, cache=None,
+                           ip_addresses=excluded_ips):
+    """
+    Return a single loop equivalent of ``construct_parser``.
+
+    Each line is run through all of the parsing stages in turn, moving on to
+    the next line as soon as one of them rejects it.
+    """
+
+    ip_addresses = tuple(ip_addresses)
+    months = None
+    if dates:
+        months = re.compile('|'.join(re.escape(d) for d in dates))
+
+    def parse(lines):
+        for line in lines:
+            if '/openaccess-disseminate/' not in line or \
+               ' "GET ' not in line or \
+               line.startswith(ip_addresses):
+                continue
+            if months is not None and not months.search(line):
+                continue
+            match = pattern.match(line)
+            if match is None:
+                continue
+            request = Request(match.groups())
+            if request.status != '200':
+                continue
+            ua = request.user_agent.lower()
+            if ua.startswith(bots_startswith) or \
+               any(s in ua for s in bots_contain):
+                continue
+            try:
+                request.time = to_iso_date(request.time)
+            except arrow.parser.ParserError:
+                logger.warn("Could not parse date string {}".format(
+                            request.time))
+                continue
+            try:
+                request.country = lookup_country(request.remote_host, reader,
+                                                 cache)
+            except (ValueError, KeyError):
+                logger.warn("Could not process host IP {}".format(
+                            request.remote_host))
+                continue
+            yield request
+    return parse
+
+
+def construct_fused_pipeline(session, reader, dspace, dates, cache=None,
+                             concurrency=1):
+    """Return a single loop equivalent of ``construct_pipeline``."""
+
+    parse = construct_fused_parser(reader, dates, cache)
+
+    def pipeline(lines):
+        for request, data in fetch_identities(parse(lines), dspace, session,
+                                              concurrency):
+            if data and data.get('success'):
+                request.dlcs = data.get('departments')
+                request.handle = data.get('uri')
+                request.title = data.get('title')
+                request.authors = [author for authors in
+                                   data.get('ids', []) for author in authors]
+                yield request
+    return pipeline
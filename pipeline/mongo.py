@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+from pymongo import UpdateOne
+
+
+class SummaryWriter(object):
+    """
+    Write summary objects to a Mongo collection in batches.
+
+    Objects are buffered and sent to Mongo ``batch_size`` at a time as a
+    single unordered ``bulk_write`` of upserts. With ``swap``, the objects
+    are instead inserted into a fresh ``<collection>_new`` collection which
+    replaces ``collection`` once the writer is closed. If an error occurs
+    inside a ``with`` block the new collection is left in place and the
+    original is not touched.
+    """
+
+    def __init__(self, collection, batch_size=1000, swap=False):
+        self.target = collection
+        self.batch_size = batch_size
+        self.swap = swap
+        self.collection = collection
+        if swap:
+            self.collection = collection.database[collection.name + '_new']
+            self.collection.drop()
+        self._buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def write(self, obj):
+        if self.swap:
+            self._buffer.append(obj)
+        else:
+            self._buffer.append(UpdateOne({'_id': obj['_id']},
+                                          {'$set': obj}, upsert=True))
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        if self.swap:
+            self.collection.insert_many(self._buffer, ordered=False)
+        else:
+            self.collection.bulk_write(self._buffer, ordered=False)
+        self._buffer = []
+
+    def close(self):
+        self.flush()
+        if self.swap:
+            self.collection.rename(self.target.name, dropTarget=True)
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from collections import deque
+from itertools import islice
+import multiprocessing
+import sys
+import traceback
+
+import pymongo
+from sqlalchemy import create_engine
+from sqlalchemy.sql import select
+
+from pipeline.cache import LRUCache
+from pipeline.db import authors, dlcs, documents
+from pipeline.fused import construct_fused_parser
+from pipeline.mongo import SummaryWriter
+from pipeline.pipeline import construct_parser, open_reader
+from pipeline.query import chunks
+from pipeline.readers import (SEGMENT_SIZE, compression, mmap_lines,
+                              open_log, read_ahead, read_segment, segments)
+from pipeline.summary import author, dlc, handle
+
+
+BATCH_SIZE = 10000
+SHARD_SIZE = 100
+PARSERS = {'compose': construct_parser, 'fused': construct_fused_parser}
+SUMMARIES = (('author', authors.c.mit_id, author),
+             ('dlc', dlcs.c.id, dlc),
+             ('handle', documents.c.id, handle))
+
+_parser = None
+_cache = None
+_read_segment = read_segment
+_summarizer = None
+
+
+class SummaryError(Exception):
+    pass
+
+
+def parse_parallel(files, geo_ip, dates, workers, size=SEGMENT_SIZE,
+                   engine='compose', cache=None, raw=False, use_mmap=False):
+    """
+    Run the parsing stages of the pipeline in a pool of worker processes.
+
+    Files are split into segments of about ``size`` bytes and each segment
+    is filtered, parsed and geolocated by one of ``workers`` processes.
+    Input from STDIN (``-``, or no files at all) and compressed files, which
+    cannot be split, are sent to the workers in batches of lines instead.
+    The parsed requests are yielded in the same order as they appear in the
+    input. Only a few segments per worker are processed ahead of the
+    consumer. ``engine`` selects the parser used by the workers, either
+    ``compose`` or ``fused``. If a ``cache`` is given each worker uses a
+    country cache of the same size, and the hits and misses from every
+    worker are added to those of ``cache``. ``raw`` is passed to
+    ``open_reader`` when opening the GeoIP database. With ``use_mmap`` the
+    workers read segments with ``mmap_lines``.
+    """
+
+    cache_size = cache.size if cache is not None else None
+    pool = multiprocessing.Pool(workers, _init_worker,
+                                (geo_ip, dates, engine, cache_size, raw,
+                                 use_mmap))
+    try:
+        pending = deque()
+        for task in _tasks(files, size):
+            pending.append(pool.apply_async(_parse, (task,)))
+            if len(pending) >= workers * 2:
+                for request in _results(pending.popleft(), cache):
+                    yield request
+        while pending:
+            for request in _results(pending.popleft(), cache):
+                yield request
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _tasks(files, size):
+    for path in files or ['-']:
+        if path == '-' or compression(path):
+            lines = sys.stdin if path == '-' else read_ahead(open_log(path))
+            while True:
+                batch = list(islice(lines, BATCH_SIZE))
+                if not batch:
+                    break
+                yield batch
+        else:
+            for segment in segments([path], size):
+                yield segment
+
+
+def _results(result, cache):
+    requests, hits, misses = result.get()
+    if cache is not None:
+        cache.hits += hits
+        cache.misses += misses
+    return requests
+
+
+def _init_worker(geo_ip, dates, engine, cache_size, raw, use_mmap):
+    global _parser, _cache, _read_segment
+    if use_mmap:
+        _read_segment = mmap_lines
+    reader = open_reader(geo_ip, raw)
+    if cache_size is not None:
+        _cache = LRUCache(cache_size)
+    _parser = PARSERS[engine](reader, dates, _cache)
+
+
+def _parse(task):
+    before = _counts()
+    if isinstance(task, list):
+        requests = list(_parser(task))
+    else:
+        requests = list(_parser(_read_segment(*task)))
+    after = _counts()
+    return requests, after[0] - before[0], after[1] - before[1]
+
+
+def _counts():
+    if _cache is None:
+        return 0, 0
+    return _cache.hits, _cache.misses
+
+
+def summary_shards(conn, size=SHARD_SIZE):
+    """
+    Return the authors, DLCs and handles to summarize split into shards.
+
+    Each shard is a tuple of the kind of entity (``author``, ``dlc`` or
+    ``handle``) and a list of up to ``size`` of their ids.
+    """
+    shards = []
+    for kind, column, _ in SUMMARIES:
+        ids = [row[0] for row in
+               conn.execute(select([column]).order_by(column))]
+        shards.extend((kind, chunk) for chunk in chunks(ids, size))
+    return shards
+
+
+def summarize_parallel(shards, database, mongo, mongo_db, mongo_coll, jobs,
+                       batch_size=1000, summaries=None):
+    """
+    Write the summary objects for ``shards`` using a pool of processes.
+
+    Each of the ``jobs`` worker processes connects to ``database`` and
+    ``mongo`` itself. A worker summarizes each of its shards with the same
+    per entity queries as ``author_objs``, ``dlc_objs`` and
+    ``handle_objs``, or the function for its kind in ``summaries`` if
+    given, and upserts the objects into ``mongo_coll`` in batches of
+    ``batch_size``. The functions are sent to the workers, so they must be
+    defined at the top level of a module. The number of entities in each
+    shard is yielded once all of its objects have been written, in the
+    order the shards finish. If any shard fails the rest are abandoned and
+    a ``SummaryError`` with the worker's traceback is raised.
+    """
+
+    if summaries is None:
+        summaries = dict((kind, f) for kind, _, f in SUMMARIES)
+    pool = multiprocessing.Pool(jobs, _init_summarizer,
+                                (database, mongo, mongo_db, mongo_coll,
+                                 batch_size, summaries))
+    try:
+        for count in pool.imap_unordered(_summarize, shards):
+            yield count
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class Summarizer(object):
+    """
+    Summarize shards of entities in a worker process.
+
+    The connections are only opened for the first shard, so that a
+    database or Mongo which can't be reached fails that shard rather than
+    the process.
+    """
+
+    def __init__(self, database, mongo, mongo_db, mongo_coll, batch_size,
+                 summaries):
+        self.database = database
+        self.mongo = mongo
+        self.mongo_db = mongo_db
+        self.mongo_coll = mongo_coll
+        self.batch_size = batch_size
+        self.summaries = summaries
+        self.conn = None
+        self.collection = None
+
+    def __call__(self, kind, ids):
+        if self.conn is None:
+            self.conn = create_engine(self.database).connect()
+            client = pymongo.MongoClient(self.mongo)
+            self.collection = client[self.mongo_db][self.mongo_coll]
+        summary = self.summaries[kind]
+        with SummaryWriter(self.collection, self.batch_size) as writer:
+            for entity_id in ids:
+                writer.write(summary(entity_id, self.conn))
+        return len(ids)
+
+
+def _init_summarizer(database, mongo, mongo_db, mongo_coll, batch_size,
+                     summaries):
+    global _summarizer
+    _summarizer = Summarizer(database, mongo, mongo_db, mongo_coll,
+                             batch_size, summaries)
+
+
+def _summarize(shard):
+    kind, ids = shard
+    try:
+        return _summarizer(kind, ids)
+    except Exception:
+        raise SummaryError('Summarizing the {} shard from {} to {} '
+                           'failed:\n{}'.format(kind, ids[0], ids[-1],
+                                                 traceback.format_exc()))
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import datetime
+
+from sqlalchemy.schema import CreateColumn, CreateIndex
+from sqlalchemy.sql import text
+
+from pipeline.db import request_table, requests
+from pipeline.rollup import rebuild
+
+
+class PartitionError(Exception):
+    pass
+
+
+def create_partitioned(conn, table=requests):
+    """
+    Create ``table`` range partitioned by month.
+
+    The table has the same columns and indexes as the unpartitioned one,
+    but its primary key includes ``datetime`` as PostGres requires. No
+    partitions are created; see :func:`create_partitions`.
+    """
+
+    columns = [str(CreateColumn(c).compile(dialect=conn.dialect))
+               for c in table.columns]
+    columns.append('PRIMARY KEY (id, datetime)')
+    for fk in table.foreign_keys:
+        columns.append('FOREIGN KEY ({}) REFERENCES {} ({})'.format(
+            fk.parent.name, fk.column.table.name, fk.column.name))
+    conn.execute('CREATE TABLE {} (\n\t{}\n) PARTITION BY RANGE '
+                 '(datetime)'.format(table.name, ',\n\t'.join(columns)))
+    for index in table.indexes:
+        conn.execute(CreateIndex(index))
+
+
+def is_partitioned(conn):
+    """Return whether the table requests are stored in is partitioned."""
+    if conn.dialect.name != 'postgresql':
+        return False
+    return conn.execute(text('SELECT count(*) FROM pg_partitioned_table '
+                             'WHERE partrelid = to_regclass(:name)'),
+                        name=request_table(conn).name).scalar() > 0
+
+
+def partition_exists(conn, name):
+    return conn.execute(text('SELECT to_regclass(:name) IS NOT NULL'),
+                        name=name).scalar()
+
+
+def create_partitions(conn, months):
+    """Create the partitions for ``months`` which don't exist yet."""
+    table = request_table(conn)
+    for month in months:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES "
+            "FROM ('{}') TO ('{}')".format(partition_name(month, table),
+                                           table.name, month,
+                                           next_month(month)))
+
+
+def truncate_month(conn, month):
+    """
+    Remove the requests for ``month`` and its days from the rollups.
+
+    If the requests are stored in a partitioned table the month's partition
+    is truncated; otherwise the requests are deleted. A
+    :class:`PartitionError` is raised if the month has no partition.
+    """
+
+    start, end = month, next_month(month)
+    table = request_table(conn)
+    with conn.begin():
+        if is_partitioned(conn):
+            partition = partition_name(month, table)
+            if not partition_exists(conn, partition):
+                raise PartitionError('There is no partition for {}'.format(
+                                     month.strftime('%Y-%m')))
+            conn.execute('TRUNCATE TABLE {}'.format(partition))
+        else:
+            conn.execute(table.delete()
+                         .where(table.c.datetime >= start)
+                         .where(table.c.datetime < end))
+        rebuild(conn, start, end)
+
+
+class PartitionCreator(object):
+    """
+    Create the partitions for request rows before they are loaded.
+
+    Calling this with a connection and rows as written to a sink creates
+    any partitions that are missing for their months. Whether the table is
+    partitioned is checked on the first call, and each month is only
+    created once. As with ``RequestEncoder``, the months created since the
+    last ``commit`` are forgotten by ``rollback`` if the transaction they
+    were created in is rolled back.
+    """
+
+    def __init__(self):
+        self.partitioned = None
+        self.months = set()
+        self._pending = set()
+
+    def __call__(self, conn, rows):
+        if self.partitioned is None:
+            self.partitioned = is_partitioned(conn)
+        if not self.partitioned:
+            return
+        months = set(month_of(row[5]) for row in rows) - self.months
+        create_partitions(conn, sorted(months))
+        self.months.update(months)
+        self._pending.update(months)
+
+    def commit(self):
+        self._pending = set()
+
+    def rollback(self):
+        self.months -= self._pending
+        self._pending = set()
+
+
+def months(start, end):
+    """Return the first day of each month from ``start`` to ``end``."""
+    result = []
+    month = first_of_month(start)
+    while month <= end:
+        result.append(month)
+        month = next_month(month)
+    return result
+
+
+def partition_name(month, table=requests):
+    return '{}_y{:04d}m{:02d}'.format(table.name, month.year, month.month)
+
+
+def month_of(timestamp):
+    """Return the first day of the month of an ISO 8601 timestamp."""
+    return datetime.date(int(timestamp[:4]), int(timestamp[5:7]), 1)
+
+
+def first_of_month(date):
+    return datetime.date(date.year, date.month, 1)
+
+
+def next_month(month):
+    return datetime.date(month.year + month.month // 12, month.month % 12 + 1,
+                         1)
+
+
+def add_months(month, count):
+    for _ in range(count):
+        month = next_month(month)
+    return month
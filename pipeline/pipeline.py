@@ -1,16 +1,24 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
+from collections import deque
+from datetime import datetime
 from functools import partial, reduce
 import logging
+from multiprocessing.pool import ThreadPool
 import re
 
 
 import arrow
+import geoip2.database
 from geoip2.errors import AddressNotFoundError
+import maxminddb
+import maxminddb.const
 import pycountry
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
-from pipeline.cache import region
+from pipeline.cache import NO_VALUE, identities, region
 
 
 field_names = ('remote_host', 'remote_logname', 'remote_user', 'time',
@@ -25,6 +33,15 @@ bots_contain = ('bot', 'crawler', 'spider', 'findlinks', 'feedfetcher',
                 'slurp', 'sensis', 'jeeves', 'nutch', 'harvest', 'larbin',
                 'archiver', 'ichiro', 'scrubby', 'silk', 'referee',
                 'webcollages', 'store')
+excluded_ips = ('127.0.0.1', '18.7.27.25', '::1')
+timestamp = re.compile(r'([0-9]{2})/([A-Z][a-z]{2})/([0-9]{4}):([0-9]{2}):'
+                       r'([0-9]{2}) ([+-])([0-9]{2})([0-9]{2})$')
+months = dict((m, i) for i, m in enumerate(('Jan', 'Feb', 'Mar', 'Apr', 'May',
+                                            'Jun', 'Jul', 'Aug', 'Sep', 'Oct',
+                                            'Nov', 'Dec'), 1))
+seconds = frozenset('{:02d}'.format(s) for s in range(60))
+alpha3_codes = dict((c.alpha_2, c.alpha_3) for c in pycountry.countries)
+quotable = re.compile(r'[,"\n\r]')
 
 
 logger = logging.getLogger(__name__)
@@ -57,28 +74,113 @@ def get_alpha2_code(ip, database):
     return 'XX'
 
 
+def get_raw_alpha2_code(ip, database):
+    """
+    Equivalent of ``get_alpha2_code`` for a plain ``maxminddb`` reader.
+
+    Only the keys that are needed are read from the database record, so no
+    ``geoip2`` model objects are created for each lookup.
+    """
+    record = database.get(ip)
+    if record is None:
+        return 'XX'
+    iso_code = record.get('country', {}).get('iso_code')
+    if iso_code is not None:
+        return iso_code
+    traits = record.get('traits', {})
+    if traits.get('is_anonymous_proxy'):
+        return 'XA'
+    if traits.get('is_satellite_provider'):
+        return 'XS'
+    return 'XX'
+
+
 def get_alpha3_code(alpha2):
-    country = pycountry.countries.get(alpha_2=alpha2)
-    return country.alpha_3
+    return alpha3_codes[alpha2]
+
+
+_timestamps = {}
 
 
 def to_iso_date(date):
+    """
+    Convert an Apache log timestamp to an ISO 8601 string.
+
+    Timestamps are sliced apart by position rather than parsed by arrow.
+    Everything but the seconds is converted once and cached, so requests
+    logged in the same minute only need their seconds copied over. Any
+    timestamp that doesn't fit the Apache layout is left to arrow.
+    """
+    if len(date) == 26 and date[17] == ':' and date[18:20] in seconds:
+        key = date[:17] + date[20:]
+        parts = _timestamps.get(key)
+        if parts is None:
+            parts = _timestamp_parts(key)
+        if parts:
+            return parts[0] + date[18:20] + parts[1]
     dt = arrow.get(date, 'DD/MMM/YYYY:HH:mm:ss Z')
     return dt.isoformat()
 
 
+def _timestamp_parts(key):
+    match = timestamp.match(key)
+    if match is None or match.group(2) not in months:
+        return None
+    day, month, year, hour, minute, sign, off_h, off_m = match.groups()
+    try:
+        datetime(int(year), months[month], int(day), int(hour), int(minute))
+    except ValueError:
+        return None
+    if int(off_h) > 23 or int(off_m) > 59:
+        return None
+    if off_h == off_m == '00':
+        sign = '+'
+    if len(_timestamps) >= 4096:
+        _timestamps.clear()
+    parts = ('{}-{:02d}-{}T{}:{}:'.format(year, months[month], day, hour,
+                                          minute),
+             '{}{}:{}'.format(sign, off_h, off_m))
+    _timestamps[key] = parts
+    return parts
+
+
+def open_reader(path, raw=False):
+    """
+    Open a GeoIP database, either with ``geoip2`` or, if ``raw`` is true, as
+    a plain ``maxminddb`` reader. ``to_country`` accepts either. The raw
+    reader uses the ``maxminddb`` C extension when it is available.
+    """
+    if raw:
+        return maxminddb.open_database(path, maxminddb.const.MODE_AUTO)
+    return geoip2.database.Reader(path, mode=maxminddb.const.MODE_MMAP)
+
+
 def to_country(ip_address, reader):
-    alpha2 = get_alpha2_code(ip_address, reader)
+    if isinstance(reader, geoip2.database.Reader):
+        alpha2 = get_alpha2_code(ip_address, reader)
+    else:
+        alpha2 = get_raw_alpha2_code(ip_address, reader)
     if alpha2 in ('XA', 'XS', 'XX'):
         return 'XXX'
     return get_alpha3_code(alpha2)
 
 
+def lookup_country(ip_address, reader, cache=None):
+    """Look up the country code for an IP address in an optional cache."""
+    if cache is None:
+        return to_country(ip_address, reader)
+    ccode = cache.get(ip_address)
+    if ccode is None:
+        ccode = to_country(ip_address, reader)
+        cache.set(ip_address, ccode)
+    return ccode
+
+
 def filter_by_date(lines, dates=None):
     for line in lines:
         if not dates:
             yield line
-        elif any([d in line for d in dates]):
+        elif any(d in line for d in dates):
             yield line
 
 
@@ -88,9 +190,33 @@ def filter_by_method(lines):
             yield line
 
 
-def filter_by_ip(lines, ip_addresses=('127.0.0.1', '18.7.27.25', '::1')):
+def filter_by_ip(lines, ip_addresses=excluded_ips):
+    ip_addresses = tuple(ip_addresses)
+    for line in lines:
+        if not line.startswith(ip_addresses):
+            yield line
+
+
+def prefilter(lines, dates=None, ip_addresses=excluded_ips):
+    """
+    Filter lines by method, date and IP address in a single pass.
+
+    This is equivalent to ``filter_by_method``, ``filter_by_date`` and
+    ``filter_by_ip`` combined, but also discards any line which is not an
+    open access request before the more expensive checks are run. As most
+    lines in the logs are for other requests, this saves running the full
+    pattern against them in ``parse_into_dict``.
+    """
+    ip_addresses = tuple(ip_addresses)
+    months = None
+    if dates:
+        months = re.compile('|'.join(re.escape(d) for d in dates))
     for line in lines:
-        if not any([line.startswith(ip) for ip in ip_addresses]):
+        if '/openaccess-disseminate/' not in line or \
+           ' "GET ' not in line or \
+           line.startswith(ip_addresses):
+            continue
+        if months is None or months.search(line):
             yield line
 
 
@@ -126,10 +252,10 @@ def convert_datetime(requests):
                         request.get('time')))
 
 
-def add_country(requests, reader):
+def add_country(requests, reader, cache=None):
     for request in requests:
         try:
-            ccode = to_country(request.get('remote_host'), reader)
+            ccode = lookup_country(request.get('remote_host'), reader, cache)
             request['country'] = ccode
             yield request
         except (ValueError, KeyError) as e:
@@ -139,19 +265,132 @@ def add_country(requests, reader):
 
 @region.cache_on_arguments()
 def get_bitstream(handle, svc_url, session):
+    data = identities.get(handle)
+    if data is not NO_VALUE:
+        return data
     r = session.get(svc_url, params={'handle': handle})
     try:
         r.raise_for_status()
     except requests.HTTPError as e:
         logger.warn(e)
-        return None
-    return r.json()
+        if r.status_code != 404:
+            # Server errors may only be temporary, so they are not kept
+            # in the identity cache for later runs.
+            return None
+        data = None
+    else:
+        data = r.json()
+    identities.set(handle, data)
+    return data
+
+
+def configure_session(session, concurrency=1, retries=0, backoff=0):
+    """
+    Set up a session for making ``concurrency`` simultaneous requests.
+
+    Failed connections and server errors are retried up to ``retries``
+    times, waiting ``backoff`` seconds, then twice that and so on, between
+    attempts.
+    """
+    retry = Retry(total=retries, backoff_factor=backoff,
+                  status_forcelist=(500, 502, 503, 504),
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_maxsize=concurrency, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def url_to_handle(url):
+    return url.split("/", 2).pop()
+
+
+def fetch_identities(requests, svc_url, session, concurrency=1,
+                     window=None):
+    """
+    Yield each request along with its bitstream.
+
+    With a ``concurrency`` greater than one, up to ``window`` requests (100
+    per thread by default) are read ahead of the one being yielded, and the
+    bitstreams for their handles are fetched by a pool of ``concurrency``
+    threads. Each handle is only fetched once while it is in the window.
+    Requests are always yielded in their original order.
+    """
+    if concurrency <= 1:
+        for request in requests:
+            handle = url_to_handle(request['request_url'])
+            yield request, get_bitstream(handle, svc_url, session)
+        return
+    window = window or concurrency * 100
+    pool = ThreadPool(concurrency)
+    try:
+        pending = deque()
+        fetches = {}
+        for request in requests:
+            handle = url_to_handle(request['request_url'])
+            if handle not in fetches:
+                fetches[handle] = [pool.apply_async(get_bitstream,
+                                   (handle, svc_url, session)), 0]
+            fetches[handle][1] += 1
+            pending.append((request, handle))
+            if len(pending) >= window:
+                yield _next_identity(pending, fetches)
+        while pending:
+            yield _next_identity(pending, fetches)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _next_identity(pending, fetches):
+    request, handle = pending.popleft()
+    fetch = fetches[handle]
+    fetch[1] -= 1
+    if not fetch[1]:
+        del fetches[handle]
+    return request, fetch[0].get()
+
+
+def collect_handles(lines, dates=None):
+    """
+    Return the set of handles requested in ``lines``.
+
+    Only the filtering and parsing stages needed to find the requests which
+    will have their identities looked up by the pipeline are run.
+    """
+    reqs = filter_bots(filter_by_status(parse_into_dict(prefilter(lines,
+                                                                  dates))))
+    return set(url_to_handle(r['request_url']) for r in reqs)
+
+
+def prefetch_identities(handles, svc_url, session, concurrency=1):
+    """
+    Look up the bitstreams for ``handles`` so they are cached for later.
+
+    The lookups are made by a pool of ``concurrency`` threads. Each handle
+    is yielded once its bitstream has been fetched.
+    """
+    pool = ThreadPool(concurrency)
+    try:
+        for handle in pool.imap_unordered(
+                partial(_prefetch, svc_url=svc_url, session=session),
+                handles):
+            yield handle
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
 
 
-def add_identities(requests, svc_url, session):
-    for request in requests:
-        handle = request['request_url'].split("/", 2).pop()
-        data = get_bitstream(handle, svc_url, session)
+def _prefetch(handle, svc_url, session):
+    get_bitstream(handle, svc_url, session)
+    return handle
+
+
+def add_identities(requests, svc_url, session, concurrency=1):
+    for request, data in fetch_identities(requests, svc_url, session,
+                                          concurrency):
         if data and data.get('success'):
             request['dlcs'] = data.get('departments')
             request['handle'] = data.get('uri')
@@ -161,30 +400,32 @@ def add_identities(requests, svc_url, session):
             yield request
 
 
-def construct_pipeline(session, reader, dspace, dates):
-    _add_country = partial(add_country, reader=reader)
-    _filter_by_date = partial(filter_by_date, dates=dates)
-    _add_identities = partial(add_identities, svc_url=dspace, session=session)
+def construct_parser(reader, dates, cache=None):
+    _add_country = partial(add_country, reader=reader, cache=cache)
+    _prefilter = partial(prefilter, dates=dates)
 
-    return compose(_add_identities,
-                   _add_country,
+    return compose(_add_country,
                    convert_datetime,
                    filter_bots,
                    filter_by_status,
                    parse_into_dict,
-                   filter_by_ip,
-                   _filter_by_date,
-                   filter_by_method,)
+                   _prefilter,)
+
+
+def construct_pipeline(session, reader, dspace, dates, cache=None,
+                       concurrency=1):
+    _add_identities = partial(add_identities, svc_url=dspace, session=session,
+                              concurrency=concurrency)
+
+    return compose(_add_identities,
+                   construct_parser(reader, dates, cache),)
 
 
 def quote_field(field):
-    quotable = (',', '"', '\n', '\r')
-    value = field.replace('"', '""')
-    if any([s in value for s in quotable]) or value == '\.':
-        value = '"{}"'.format(value)
-    return value
+    if quotable.search(field) is None:
+        return '"\\."' if field == '\\.' else field
+    return '"' + field.replace('"', '""') + '"'
 
 
 def to_csv(request):
-    row = [quote_field(field) for field in request]
-    return ','.join(row)
+    return ','.join(map(quote_field, request))
@@ -1,13 +1,19 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
+from collections import OrderedDict
+from itertools import islice
 
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.sql import select
 
-from pipeline.db import (authors, dlcs, documents, documents_dlcs,
-                         documents_authors)
+from pipeline.db import (authors, countries, dlcs, documents, documents_dlcs,
+                         documents_authors, referers, user_agents, value_hash)
 from pipeline.cache import region
 
 
+CHUNK_SIZE = 400
+
+
 def get_or_create(conn, table, id_column, id, **kwargs):
     p_key = conn.scalar(select([table.c.id]).where(id_column == id))
     if p_key is None:
@@ -54,6 +60,258 @@ def get_document(handle, title, authors, dlcs, conn):
         return p_key
 
 
+class Resolver(object):
+    """
+    Base class for resolving the ids of rows in lookup tables in bulk.
+
+    The ids of rows not seen before are looked up with one ``IN`` query per
+    chunk and the missing rows are created with multi-row inserts. Tables
+    with a ``hash`` column are looked up by the hash of the key instead.
+    Rows inserted concurrently by another process are ignored (using ``ON
+    CONFLICT DO NOTHING`` on PostgreSQL) and then looked up. Resolved ids
+    are kept for the life of the resolver.
+
+    After ``preload`` has been called, the resolver's ids are treated as
+    the complete contents of the tables and anything not in them is
+    inserted without being looked up first.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.preloaded = False
+
+    def _preload(self, tables):
+        streaming = self.conn.execution_options(stream_results=True)
+        for ids, table, column in tables:
+            rows = streaming.execute(select([column, table.c.id]))
+            ids.update((key, p_key) for key, p_key in rows)
+        self.preloaded = True
+
+    def _resolve(self, table, column, rows, ids):
+        """
+        Add the ids for ``rows``, keyed on ``column``, to ``ids``.
+
+        Returns the keys of the rows which this resolver inserted. Rows
+        which were missing but were inserted by another process first are
+        looked up and not returned.
+        """
+        keys = [k for k in rows if k not in ids]
+        if not self.preloaded:
+            self._lookup(table, column, keys, ids)
+        missing = [k for k in keys if k not in ids]
+        created = []
+        for chunk in chunks(missing, CHUNK_SIZE):
+            created.extend(self._insert(table, column,
+                                        [rows[k] for k in chunk], ids))
+        self._lookup(table, column, [k for k in missing if k not in ids],
+                     ids)
+        return created
+
+    def _lookup(self, table, column, keys, ids):
+        hashed = 'hash' in table.c
+        lookup = table.c.hash if hashed else column
+        for chunk in chunks(keys, CHUNK_SIZE):
+            by_key = dict((value_hash(k) if hashed else k, k) for k in chunk)
+            rows = self.conn.execute(select([lookup, table.c.id]).
+                                     where(lookup.in_(list(by_key))))
+            ids.update((by_key[key], p_key) for key, p_key in rows)
+
+    def _insert(self, table, column, rows, ids):
+        """
+        Insert ``rows``, ignoring any which conflict with existing rows.
+
+        Returns the keys of the rows which were inserted. On PostgreSQL
+        their ids are returned by the insert and added to ``ids``; other
+        databases insert the rows one at a time to tell which were ignored.
+        """
+        if self.conn.dialect.name == 'postgresql':
+            inserted = self.conn.execute(
+                pg_insert(table).values(rows).on_conflict_do_nothing()
+                .returning(column, table.c.id)).fetchall()
+            ids.update((key, p_key) for key, p_key in inserted)
+            return [key for key, _ in inserted]
+        insert = table.insert().prefix_with('OR IGNORE', dialect='sqlite')
+        return [row[column.name] for row in rows
+                if self.conn.execute(insert, row).rowcount]
+
+
+class DocumentResolver(Resolver):
+    """
+    Resolve the document ids for chunks of requests.
+
+    Rather than looking up each document, author and DLC on its own, the
+    ones not seen before in a chunk are resolved together as described for
+    ``Resolver``.
+
+    As with ``get_document``, the authors and DLCs of a document are only
+    linked to it when the document is created, using those of the first
+    request for it in the chunk.
+    """
+
+    def __init__(self, conn):
+        super(DocumentResolver, self).__init__(conn)
+        self.documents = {}
+        self.authors = {}
+        self.dlcs = {}
+
+    def preload(self):
+        """Load the ids of all existing documents, authors and DLCs."""
+        self._preload(((self.documents, documents, documents.c.handle),
+                       (self.authors, authors, authors.c.mit_id),
+                       (self.dlcs, dlcs, dlcs.c.canonical_name)))
+
+    def resolve(self, requests):
+        """Return a dict of handle to document id for ``requests``."""
+        new = OrderedDict()
+        for request in requests:
+            handle = request['handle']
+            if handle not in self.documents and handle not in new:
+                new[handle] = request
+        if new:
+            with self.conn.begin():
+                self._resolve_documents(new)
+        return dict((r['handle'], self.documents[r['handle']])
+                    for r in requests)
+
+    def _resolve_documents(self, requests):
+        author_rows = OrderedDict()
+        dlc_rows = OrderedDict()
+        for request in requests.values():
+            for author in request.get('authors', []):
+                if valid_author(author):
+                    author_rows[author['mitid']] = {'mit_id': author['mitid'],
+                                                    'name': author['name']}
+            for dlc in request.get('dlcs', []):
+                if valid_dlc(dlc):
+                    dlc_rows[dlc['canonical']] = {
+                        'canonical_name': dlc['canonical'],
+                        'display_name': dlc['display']}
+        self._resolve(authors, authors.c.mit_id, author_rows, self.authors)
+        self._resolve(dlcs, dlcs.c.canonical_name, dlc_rows, self.dlcs)
+        doc_rows = OrderedDict((h, {'handle': h, 'title': r['title']})
+                               for h, r in requests.items())
+        created = self._resolve(documents, documents.c.handle, doc_rows,
+                                self.documents)
+        author_links = []
+        dlc_links = []
+        for handle in created:
+            request = requests[handle]
+            doc_id = self.documents[handle]
+            author_links.extend(
+                {'document_id': doc_id,
+                 'author_id': self.authors[author['mitid']]}
+                for author in request.get('authors', [])
+                if valid_author(author))
+            dlc_links.extend(
+                {'document_id': doc_id,
+                 'dlc_id': self.dlcs[dlc['canonical']]}
+                for dlc in request.get('dlcs', []) if valid_dlc(dlc))
+        for chunk in chunks(author_links, CHUNK_SIZE):
+            self.conn.execute(documents_authors.insert().values(chunk))
+        for chunk in chunks(dlc_links, CHUNK_SIZE):
+            self.conn.execute(documents_dlcs.insert().values(chunk))
+
+
+class RequestEncoder(Resolver):
+    """
+    Replace the country, referer and user agent of request rows with ids.
+
+    This produces rows for the ``request_facts`` table of the normalized
+    schema from rows as written to a sink. The values are resolved to ids
+    in the ``countries``, ``referers`` and ``user_agents`` tables as
+    described for ``Resolver``, so that only values not seen before are
+    looked up. Empty values are left empty.
+
+    When rows are encoded inside a larger transaction, the values inserted
+    for them are rolled back with it. The ids resolved since the last call
+    to ``commit`` can then be forgotten by calling ``rollback``, so that
+    they are not used for later rows.
+    """
+
+    fields = ((1, countries, countries.c.code),
+              (3, referers, referers.c.referer),
+              (4, user_agents, user_agents.c.user_agent))
+
+    def __init__(self, conn):
+        super(RequestEncoder, self).__init__(conn)
+        self.ids = dict((table.name, {}) for _, table, _ in self.fields)
+        self._pending = []
+
+    def preload(self):
+        """Load the ids of all existing countries, referers and user agents."""
+        self._preload((self.ids[table.name], table, column)
+                      for _, table, column in self.fields)
+
+    def encode(self, rows):
+        """Return ``rows`` with their values replaced by ids."""
+        new = []
+        for index, table, column in self.fields:
+            ids = self.ids[table.name]
+            values = OrderedDict((row[index], _row(table, column,
+                                                   row[index]))
+                                 for row in rows
+                                 if row[index] and row[index] not in ids)
+            if values:
+                new.append((table, column, values, ids))
+        if new:
+            self._pending.extend((ids, list(values))
+                                 for _, _, values, ids in new)
+            with self.conn.begin():
+                for table, column, values, ids in new:
+                    self._resolve(table, column, values, ids)
+        countries, referers, user_agents = [self.ids[table.name] for
+                                            _, table, _ in self.fields]
+        return [(status, _id(countries, country), url,
+                 _id(referers, referer), _id(user_agents, user_agent), time,
+                 doc_id)
+                for status, country, url, referer, user_agent, time, doc_id
+                in rows]
+
+
+    def commit(self):
+        """Keep the ids resolved since the last commit."""
+        self._pending = []
+
+    def rollback(self):
+        """Forget the ids resolved since the last commit."""
+        for ids, values in self._pending:
+            for value in values:
+                ids.pop(value, None)
+        self._pending = []
+
+
+def resolve_documents(requests, resolver, size=1000):
+    """
+    Pair each request with its document id.
+
+    Requests are resolved ``size`` at a time using ``resolver``.
+    """
+    for chunk in chunks(requests, size):
+        doc_ids = resolver.resolve(chunk)
+        for request in chunk:
+            yield request, doc_ids[request['handle']]
+
+
+def chunks(items, size):
+    """Yield lists of up to ``size`` items from ``items``."""
+    items = iter(items)
+    chunk = list(islice(items, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(items, size))
+
+
+def _row(table, column, value):
+    row = {column.name: value}
+    if 'hash' in table.c:
+        row['hash'] = value_hash(value)
+    return row
+
+
+def _id(ids, value):
+    return str(ids[value]) if value else ''
+
+
 def valid_author(author):
     return all(k in author for k in ('mitid', 'name')) and \
            all(v for v in author.values())
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import bz2
+import fileinput
+import gzip
+import io
+from itertools import chain
+import mmap
+import os
+import sys
+import threading
+
+try:
+    from queue import Empty, Full, Queue
+except ImportError:
+    from Queue import Empty, Full, Queue
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+SEGMENT_SIZE = 2 ** 26
+READ_AHEAD_BATCH = 1000
+NEEDLE = b'/openaccess-disseminate/'
+
+
+def segments(files, size=SEGMENT_SIZE, offset=0):
+    """
+    Split log files into byte ranges of roughly ``size`` bytes.
+
+    Yields a ``(path, start, end)`` tuple for each range. Ranges are
+    extended to the end of the line they would otherwise split, so every
+    range starts at the beginning of a line and ends after a newline or at
+    the end of the file. The first range of each file begins at ``offset``,
+    which should be the start of a line.
+    """
+
+    for path in files:
+        length = os.path.getsize(path)
+        with io.open(path, 'rb') as fp:
+            start = offset
+            while start < length:
+                fp.seek(start + size)
+                fp.readline()
+                end = min(fp.tell(), length)
+                yield path, start, end
+                start = end
+
+
+def read_segment(path, start, end):
+    """Yield the decoded lines between the ``start`` and ``end`` offsets."""
+
+    with io.open(path, 'rb') as fp:
+        fp.seek(start)
+        remaining = end - start
+        for line in fp:
+            yield line.decode('utf-8', 'replace')
+            remaining -= len(line)
+            if remaining <= 0:
+                break
+
+
+def mmap_lines(path, start=0, end=None, needle=NEEDLE):
+    """
+    Yield the decoded lines containing ``needle`` from a memory mapped file.
+
+    The file is searched for ``needle`` as raw bytes and only the lines it
+    appears in are decoded, skipping over all of the others. ``start`` and
+    ``end`` limit the search to a range of the file, as returned by
+    ``segments``.
+    """
+
+    if end is None:
+        end = os.path.getsize(path)
+    if end <= start:
+        return
+    with io.open(path, 'rb') as fp:
+        mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        pos = start
+        while True:
+            found = mapped.find(needle, pos, end)
+            if found == -1:
+                break
+            line_start = mapped.rfind(b'\n', start, found) + 1 or start
+            line_end = mapped.find(b'\n', found, end)
+            line_end = end if line_end == -1 else line_end + 1
+            yield mapped[line_start:line_end].decode('utf-8', 'replace')
+            pos = line_end
+    finally:
+        mapped.close()
+
+
+def open_log(path, mode='r'):
+    """
+    Open a log file for reading text, decompressing it if needed.
+
+    Compressed files are detected by their magic bytes rather than their
+    extension. Gzip, bzip2 and xz are supported, as is zstandard when the
+    ``zstandard`` package is installed. The magic bytes are peeked at from
+    the stream which is then read, and anything other than a regular file,
+    such as a FIFO, is read as plain text without being checked. This can be
+    used as a ``fileinput`` open hook.
+    """
+
+    if not os.path.isfile(path):
+        return io.open(path, 'rt', encoding='utf-8', errors='replace')
+    fp = io.open(path, 'rb')
+    opener = _opener(fp.peek(6)[:6])
+    if opener is None:
+        return io.TextIOWrapper(fp, encoding='utf-8', errors='replace')
+    return _Decompressed(opener(fp), fp)
+
+
+def compression(path):
+    """
+    Return the function to open ``path`` with if it is compressed.
+
+    Only regular files are checked; anything else is never compressed, so
+    that a FIFO isn't read from before it is opened with :func:`open_log`.
+    """
+
+    if not os.path.isfile(path):
+        return None
+    with io.open(path, 'rb') as fp:
+        return _opener(fp.read(6))
+
+
+def _opener(magic):
+    for prefix, opener in compressions:
+        if magic.startswith(prefix):
+            return opener
+
+
+class _Decompressed(io.TextIOWrapper):
+    """Decoded text from a decompressed stream which closes ``raw`` too."""
+
+    def __init__(self, stream, raw):
+        super(_Decompressed, self).__init__(stream, encoding='utf-8',
+                                            errors='replace')
+        self._raw = raw
+
+    def close(self):
+        try:
+            super(_Decompressed, self).close()
+        finally:
+            self._raw.close()
+
+
+def open_input(files, use_mmap=False):
+    """
+    Return an iterator over the lines of ``files``, or STDIN if empty.
+
+    When any of the files are compressed they are decompressed by a
+    background thread which reads ahead of the caller. With ``use_mmap``,
+    uncompressed files are read with ``mmap_lines`` instead, so only their
+    lines which contain ``NEEDLE`` are returned.
+    """
+
+    if use_mmap and files:
+        return chain.from_iterable(_mapped(f) for f in files)
+    lines = fileinput.FileInput(files, openhook=open_log)
+    if any(f != '-' and compression(f) for f in files):
+        return read_ahead(lines)
+    return lines
+
+
+def _mapped(path):
+    if path == '-':
+        return sys.stdin
+    if not os.path.isfile(path):
+        return open_log(path)
+    if compression(path):
+        return read_ahead(open_log(path))
+    return mmap_lines(path)
+
+
+def read_ahead(lines, size=16, batch=READ_AHEAD_BATCH):
+    """
+    Yield from ``lines`` while a background thread reads ahead of them.
+
+    Lines are passed from the thread in lists of ``batch`` lines through a
+    queue holding up to ``size`` lists. Errors raised while reading are
+    raised again in the caller.
+    """
+
+    queue = Queue(size)
+    stop = threading.Event()
+    thread = threading.Thread(target=_read_ahead,
+                              args=(lines, queue, stop, batch))
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item = queue.get()
+            if isinstance(item, Exception):
+                raise item
+            if not item:
+                break
+            for line in item:
+                yield line
+    finally:
+        stop.set()
+        while thread.is_alive():
+            try:
+                queue.get_nowait()
+            except Empty:
+                thread.join(0.1)
+
+
+def _read_ahead(lines, queue, stop, batch):
+    try:
+        lines = iter(lines)
+        while not stop.is_set():
+            chunk = []
+            for line in lines:
+                chunk.append(line)
+                if len(chunk) == batch:
+                    break
+            if not _put(queue, chunk, stop) or not chunk:
+                return
+    except Exception as e:
+        _put(queue, e, stop)
+
+
+def _put(queue, item, stop):
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def _open_gzip(fp):
+    return gzip.GzipFile(fileobj=fp)
+
+
+def _open_bz2(fp):
+    try:
+        return bz2.BZ2File(fp)
+    except TypeError:
+        # Python 2 can only open bzip2 files by name.
+        return bz2.BZ2File(fp.name)
+
+
+def _open_xz(fp):
+    if lzma is None:
+        raise IOError('The lzma module is required to read '
+                      '{}'.format(fp.name))
+    return lzma.LZMAFile(fp)
+
+
+def _open_zstd(fp):
+    if zstandard is None:
+        raise IOError('The zstandard package is required to read '
+                      '{}'.format(fp.name))
+    return zstandard.ZstdDecompressor().stream_reader(fp, closefd=False)
+
+
+compressions = ((b'\x1f\x8b', _open_gzip),
+                (b'BZh', _open_bz2),
+                (b'\xfd7zXZ\x00', _open_xz),
+                (b'\x28\xb5\x2f\xfd', _open_zstd))
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from collections import Counter
+import datetime
+
+from sqlalchemy import and_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.sql import select, func
+
+from pipeline.db import (author_downloads, dlc_downloads, document_downloads,
+                         documents_authors, documents_dlcs, requests)
+from pipeline.query import CHUNK_SIZE, chunks
+
+
+parents = ((author_downloads, documents_authors, 'author_id'),
+           (dlc_downloads, documents_dlcs, 'dlc_id'))
+
+
+def count_downloads(rows):
+    """
+    Count request rows by document, day and country.
+
+    ``rows`` are the tuples written to a sink. Requests without a country
+    are counted under an empty string.
+    """
+
+    counts = Counter()
+    for row in rows:
+        day = datetime.date(*map(int, row[5][:10].split('-')))
+        counts[(int(row[6]), day, row[1] or '')] += 1
+    return counts
+
+
+def update(conn, counts):
+    """
+    Add ``counts`` from ``count_downloads`` to the rollup tables.
+
+    The document counts are added to ``document_downloads`` and also to
+    ``author_downloads`` and ``dlc_downloads`` for each of the document's
+    authors and DLCs. This should be run in the same transaction as the
+    requests being counted are inserted.
+    """
+
+    if not counts:
+        return
+    _upsert(conn, document_downloads, ('document_id', 'date', 'country'),
+            counts)
+    doc_ids = sorted(set(key[0] for key in counts))
+    for table, link, column in parents:
+        links = {}
+        for chunk in chunks(doc_ids, CHUNK_SIZE):
+            for doc_id, parent in conn.execute(
+                    select([link.c.document_id, link.c[column]])
+                    .where(link.c.document_id.in_(chunk))):
+                links.setdefault(doc_id, []).append(parent)
+        derived = Counter()
+        for (doc_id, day, country), downloads in counts.items():
+            for parent in links.get(doc_id, []):
+                derived[(parent, day, country)] += downloads
+        _upsert(conn, table, (column, 'date', 'country'), derived)
+
+
+def rebuild(conn, start=None, end=None):
+    """
+    Rebuild the rollup tables from the ``requests`` table.
+
+    Only the days from ``start`` up to, but not including, ``end`` are
+    rebuilt if either is given.
+    """
+
+    day = func.date(requests.c.datetime)
+    country = func.coalesce(requests.c.country, '')
+    counts = select([requests.c.document_id, day, country, func.count()])\
+        .group_by(requests.c.document_id, day, country)
+    if start is not None:
+        counts = counts.where(requests.c.datetime >= _midnight(start))
+    if end is not None:
+        counts = counts.where(requests.c.datetime < _midnight(end))
+    with conn.begin():
+        for table in (document_downloads, author_downloads, dlc_downloads):
+            conn.execute(_dates(table.delete(), table, start, end))
+        conn.execute(document_downloads.insert().from_select(
+            ['document_id', 'date', 'country', 'downloads'], counts))
+        for table, link, column in parents:
+            derived = _dates(
+                select([link.c[column], document_downloads.c.date,
+                        document_downloads.c.country,
+                        func.sum(document_downloads.c.downloads)])
+                .select_from(document_downloads.join(
+                    link,
+                    link.c.document_id == document_downloads.c.document_id))
+                .group_by(link.c[column], document_downloads.c.date,
+                          document_downloads.c.country),
+                document_downloads, start, end)
+            conn.execute(table.insert().from_select(
+                [column, 'date', 'country', 'downloads'], derived))
+
+
+def _upsert(conn, table, keys, counts):
+    rows = [dict(zip(keys, key), downloads=downloads)
+            for key, downloads in counts.items()]
+    if conn.dialect.name == 'postgresql':
+        for chunk in chunks(rows, CHUNK_SIZE):
+            insert = pg_insert(table).values(chunk)
+            conn.execute(insert.on_conflict_do_update(
+                index_elements=keys,
+                set_={'downloads': table.c.downloads +
+                      insert.excluded.downloads}))
+        return
+    for row in rows:
+        match = and_(*[table.c[k] == row[k] for k in keys])
+        result = conn.execute(table.update().where(match).values(
+            downloads=table.c.downloads + row['downloads']))
+        if not result.rowcount:
+            conn.execute(table.insert(), row)
+
+
+def _dates(query, table, start, end):
+    if start is not None:
+        query = query.where(table.c.date >= start)
+    if end is not None:
+        query = query.where(table.c.date < end)
+    return query
+
+
+def _midnight(date):
+    return datetime.datetime(date.year, date.month, date.day)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+from sqlalchemy.sql import select
+
+from pipeline.db import (countries, metadata, normalized_metadata, referers,
+                         request_facts, request_table, requests, user_agents)
+from pipeline.partitions import create_partitioned
+
+
+def create_tables(conn, partitioned=False, normalized=False):
+    """
+    Create the database tables.
+
+    With ``normalized``, the requests are stored in ``request_facts``, with
+    their country, referer and user agent replaced by ids from the
+    ``countries``, ``referers`` and ``user_agents`` lookup tables, and
+    ``requests`` is created as a view which joins them back together so
+    that it can be queried as usual. With ``partitioned``, the table the
+    requests are stored in is partitioned by month.
+    """
+
+    table = request_facts if normalized else requests
+    with conn.begin():
+        metadata.create_all(conn, tables=[t for t in metadata.sorted_tables
+                                          if t is not requests])
+        if normalized:
+            normalized_metadata.create_all(
+                conn, tables=[t for t in normalized_metadata.sorted_tables
+                              if t is not request_facts])
+        if partitioned:
+            create_partitioned(conn, table)
+        else:
+            table.create(conn)
+        if normalized:
+            conn.execute('CREATE VIEW {} AS {}'.format(
+                requests.name, requests_view().compile(dialect=conn.dialect)))
+
+
+def drop_tables(conn):
+    """Drop the database tables, whichever schema they were created with."""
+    with conn.begin():
+        if request_table(conn) is request_facts:
+            conn.execute('DROP VIEW {}'.format(requests.name))
+            normalized_metadata.drop_all(conn)
+        metadata.drop_all(conn)
+
+
+def requests_view():
+    """Return the query for the ``requests`` view of the normalized schema."""
+    return select([request_facts.c.id,
+                   request_facts.c.status,
+                   countries.c.code.label('country'),
+                   request_facts.c.url,
+                   referers.c.referer,
+                   user_agents.c.user_agent,
+                   request_facts.c.datetime,
+                   request_facts.c.document_id])\
+        .select_from(request_facts.outerjoin(countries)
+                                  .outerjoin(referers)
+                                  .outerjoin(user_agents))
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import io
+
+import arrow
+import click
+from sqlalchemy import DateTime, Integer
+
+from pipeline import rollup
+from pipeline.db import request_facts, request_table
+from pipeline.partitions import PartitionCreator
+from pipeline.pipeline import to_csv
+from pipeline.query import RequestEncoder
+
+
+COPY_SQL = 'COPY {} ({}) FROM STDIN WITH CSV'
+
+
+class CSVSink(object):
+    """
+    Write request rows to ``stream`` (STDOUT by default) as CSV.
+
+    Lines are the same as those produced by ``to_csv``, but are buffered
+    and written ``buffer_rows`` at a time rather than one by one. If
+    ``buffer_rows`` is ``0`` lines are only written when flushed, and are
+    discarded if an error occurs inside a ``with`` block.
+
+    If ``engine`` is given and its database uses the normalized schema, the
+    rows are written in the layout of the ``request_facts`` table, with the
+    ids of their country, referer and user agent.
+    """
+
+    def __init__(self, stream=None, buffer_rows=1000, engine=None):
+        self.stream = stream or click.get_text_stream('stdout')
+        self.buffer_rows = buffer_rows
+        self.conn = engine.connect() if engine is not None else None
+        self._encoder = None
+        if self.conn is not None and \
+                request_table(self.conn) is request_facts:
+            self._encoder = RequestEncoder(self.conn)
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None or self.buffer_rows:
+            self.flush()
+        if self.conn is not None:
+            self.conn.close()
+
+    def write(self, row):
+        self._rows.append(row)
+        if self.buffer_rows and len(self._rows) >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        rows = self._rows
+        if self._encoder is not None:
+            rows = self._encoder.encode(rows)
+            self._encoder.commit()
+        lines = [to_csv(row) for row in rows]
+        lines.append(u'')
+        self.stream.write(u'\n'.join(lines))
+        self.stream.flush()
+        self._rows = []
+
+    def close(self):
+        self.flush()
+        if self.conn is not None:
+            self.conn.close()
+
+
+class CopySink(object):
+    """
+    Write request rows directly into the PostgreSQL ``requests`` table.
+
+    Rows are buffered in memory and sent as CSV with ``COPY`` on a
+    connection from ``engine``, with a commit after every ``commit_every``
+    rows, or only when flushed if ``commit_every`` is ``0``. If an error
+    occurs inside a ``with`` block the uncommitted rows are discarded; rows
+    from earlier chunks remain. With ``rollups``, the rollup tables are
+    updated with the counts for each chunk in the same transaction. If the
+    ``requests`` table is partitioned, any missing partitions for the
+    months of a chunk are created before it's copied. If the database uses
+    the normalized schema the rows are encoded and copied into the
+    ``request_facts`` table instead.
+    """
+
+    def __init__(self, engine, commit_every=10000, rollups=False):
+        self.commit_every = commit_every
+        self.rollups = rollups
+        self.conn = engine.connect()
+        self._partitions = PartitionCreator()
+        self._table = None
+        self._encoder = None
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        self.conn.close()
+
+    def write(self, row):
+        self._rows.append(row)
+        if self.commit_every and len(self._rows) >= self.commit_every:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        if self._table is None:
+            self._table, self._encoder = _layout(self.conn)
+        try:
+            with self.conn.begin():
+                self._partitions(self.conn, self._rows)
+                rows = self._rows
+                if self._encoder is not None:
+                    rows = self._encoder.encode(rows)
+                buf = io.StringIO(u''.join(to_csv(row) + u'\n'
+                                           for row in rows))
+                cursor = self.conn.connection.cursor()
+                try:
+                    cursor.copy_expert(copy_sql(self._table), buf)
+                finally:
+                    cursor.close()
+                if self.rollups:
+                    rollup.update(self.conn,
+                                  rollup.count_downloads(self._rows))
+        except Exception:
+            _rollback(self._partitions, self._encoder)
+            raise
+        _commit(self._partitions, self._encoder)
+        self._rows = []
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+class InsertSink(object):
+    """
+    Insert request rows into the ``requests`` table of any database.
+
+    This is slower than ``CopySink`` but works with any database supported
+    by SQLAlchemy. Rows are committed, rollups updated, partitions created
+    and rows encoded for the normalized schema as they are for
+    ``CopySink``.
+    """
+
+    def __init__(self, engine, commit_every=10000, rollups=False):
+        self.commit_every = commit_every
+        self.rollups = rollups
+        self.conn = engine.connect()
+        self._partitions = PartitionCreator()
+        self._table = None
+        self._encoder = None
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        self.conn.close()
+
+    def write(self, row):
+        self._rows.append(row)
+        if self.commit_every and len(self._rows) >= self.commit_every:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        if self._table is None:
+            self._table, self._encoder = _layout(self.conn)
+        try:
+            with self.conn.begin():
+                self._partitions(self.conn, self._rows)
+                rows = self._rows
+                if self._encoder is not None:
+                    rows = self._encoder.encode(rows)
+                columns = _columns(self._table)
+                self.conn.execute(self._table.insert(),
+                                  [dict((c.name, _value(c, v))
+                                        for c, v in zip(columns, row))
+                                   for row in rows])
+                if self.rollups:
+                    rollup.update(self.conn,
+                                  rollup.count_downloads(self._rows))
+        except Exception:
+            _rollback(self._partitions, self._encoder)
+            raise
+        _commit(self._partitions, self._encoder)
+        self._rows = []
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+def open_sink(kind, engine, commit_every=10000, rollups=False):
+    """
+    Return the sink named by ``kind`` (``csv``, ``copy`` or ``insert``).
+
+    Rows are committed, or written, every ``commit_every`` rows. The
+    ``rollups`` flag is passed to the database sinks.
+    """
+    if kind == 'copy':
+        return CopySink(engine, commit_every, rollups)
+    if kind == 'insert':
+        return InsertSink(engine, commit_every, rollups)
+    return CSVSink(buffer_rows=commit_every, engine=engine)
+
+
+def copy_sql(table):
+    """Return the ``COPY`` statement for request rows into ``table``."""
+    return COPY_SQL.format(table.name,
+                           ', '.join(c.name for c in _columns(table)))
+
+
+def _commit(*caches):
+    for cache in caches:
+        if cache is not None:
+            cache.commit()
+
+
+def _rollback(*caches):
+    for cache in caches:
+        if cache is not None:
+            cache.rollback()
+
+
+def _layout(conn):
+    table = request_table(conn)
+    encoder = RequestEncoder(conn) if table is request_facts else None
+    return table, encoder
+
+
+def _columns(table):
+    return [c for c in table.columns if not c.primary_key]
+
+
+def _value(column, value):
+    if isinstance(column.type, DateTime):
+        return arrow.get(value).naive
+    if isinstance(column.type, Integer):
+        return int(value) if value else None
+    return value
@@ -1,11 +1,14 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
+from itertools import groupby, islice
+from operator import itemgetter
 
-from sqlalchemy import bindparam
+from sqlalchemy import DateTime, bindparam
 from sqlalchemy.sql import select, func
 
 from pipeline.db import (authors, documents_authors, requests, documents,
-                         dlcs, documents_dlcs)
+                         dlcs, documents_dlcs, summary_watermarks,
+                         author_downloads, dlc_downloads, document_downloads)
 
 
 def author_objs(conn):
@@ -63,13 +66,15 @@ def author(mit_id, conn):
     countries = select([requests.c.country, func.count().label('downloads')])\
                 .select_from(requests_to_authors)\
                 .where(authors.c.mit_id==bindparam('mit_id'))\
-                .group_by(requests.c.country)
+                .group_by(requests.c.country)\
+                .order_by(requests.c.country)
     dates = select([
-                func.date_trunc('day', requests.c.datetime).label('date'),
+                _day(requests.c.datetime).label('date'),
                 func.count().label('downloads')])\
             .select_from(requests_to_authors)\
             .where(authors.c.mit_id==bindparam('mit_id'))\
-            .group_by(func.date_trunc('day', requests.c.datetime))
+            .group_by(_day(requests.c.datetime))\
+            .order_by(_day(requests.c.datetime))
 
     author_obj = {'type': 'author'}
     res = conn.execute(totals, mit_id=mit_id).first()
@@ -108,13 +113,15 @@ def dlc(dlc_id, conn):
     countries = select([requests.c.country, func.count().label('downloads')])\
                 .select_from(requests_to_dlcs)\
                 .where(dlcs.c.id==bindparam('dlc_id'))\
-                .group_by(requests.c.country)
+                .group_by(requests.c.country)\
+                .order_by(requests.c.country)
     dates = select([
-                func.date_trunc('day', requests.c.datetime).label('date'),
+                _day(requests.c.datetime).label('date'),
                 func.count().label('downloads')])\
             .select_from(requests_to_dlcs)\
             .where(dlcs.c.id==bindparam('dlc_id'))\
-            .group_by(func.date_trunc('day', requests.c.datetime))
+            .group_by(_day(requests.c.datetime))\
+            .order_by(_day(requests.c.datetime))
     dlc_obj = {'type': 'dlc'}
     res = conn.execute(totals, dlc_id=dlc_id).first()
     dlc_obj['_id'] = {'canonical': res['canonical_name'],
@@ -146,15 +153,18 @@ def handle(doc_id, conn):
             .where(documents.c.id==bindparam('doc_id'))
     parents = select([authors.c.name, authors.c.mit_id])\
               .select_from(authors.join(documents_authors).join(documents))\
-              .where(documents.c.id==bindparam('doc_id'))
+              .where(documents.c.id==bindparam('doc_id'))\
+              .order_by(documents_authors.c.id)
     countries = select([requests.c.country, func.count().label('downloads')])\
                 .where(requests.c.document_id==bindparam('doc_id'))\
-                .group_by(requests.c.country)
+                .group_by(requests.c.country)\
+                .order_by(requests.c.country)
     dates = select([
-                func.date_trunc('day', requests.c.datetime).label('date'),
+                _day(requests.c.datetime).label('date'),
                 func.count().label('downloads')])\
             .where(requests.c.document_id==bindparam('doc_id'))\
-            .group_by(func.date_trunc('day', requests.c.datetime))
+            .group_by(_day(requests.c.datetime))\
+            .order_by(_day(requests.c.datetime))
     handle_obj = {'type': 'handle'}
     res = conn.execute(totals, doc_id=doc_id).first()
     handle_obj['_id'] = res['handle']
@@ -177,15 +187,44 @@ def handle(doc_id, conn):
     return handle_obj
 
 
-def overall(conn):
+def overall(conn, since=None, until=None):
+    downloads = _window(select([func.count()]).select_from(requests),
+                        since, until)
     totals = select([
-        select([func.count()]).select_from(requests).label('downloads'),
+        downloads.label('downloads'),
         select([func.count()]).select_from(documents).label('size')])
     countries = select([requests.c.country, func.count().label('downloads')])\
-                    .group_by(requests.c.country)
-    dates = select([func.date_trunc('day', requests.c.datetime).label('date'),
+                    .group_by(requests.c.country)\
+                    .order_by(requests.c.country)
+    dates = select([_day(requests.c.datetime).label('date'),
                     func.count().label('downloads')])\
-                .group_by(func.date_trunc('day', requests.c.datetime))
+                .group_by(_day(requests.c.datetime))\
+                .order_by(_day(requests.c.datetime))
+    countries = _window(countries, since, until)
+    dates = _window(dates, since, until)
+    return _overall_obj(conn, totals, countries, dates)
+
+
+def rollup_overall(conn):
+    """Return the same object as :func:`overall` using the rollups."""
+
+    downloads = document_downloads.c.downloads
+    country = func.nullif(document_downloads.c.country, '')
+    totals = select([
+        select([func.coalesce(func.sum(downloads), 0)]).label('downloads'),
+        select([func.count()]).select_from(documents).label('size')])
+    countries = select([country.label('country'),
+                        func.sum(downloads).label('downloads')])\
+        .group_by(country)\
+        .order_by(country)
+    dates = select([document_downloads.c.date.label('date'),
+                    func.sum(downloads).label('downloads')])\
+        .group_by(document_downloads.c.date)\
+        .order_by(document_downloads.c.date)
+    return _overall_obj(conn, totals, countries, dates)
+
+
+def _overall_obj(conn, totals, countries, dates):
     overall_obj = {'type': 'overall'}
     res = conn.execute(totals).first()
     overall_obj['downloads'] = res['downloads']
@@ -201,3 +240,312 @@ def overall(conn):
             .append({'date': row['date'].strftime('%Y-%m-%d'),
                      'downloads': row['downloads']})
     return overall_obj
+
+
+def bulk_author_objs(conn, since=None, until=None):
+    """
+    Generate all author objects using a fixed number of grouped queries.
+
+    The objects are the same as those returned by :func:`author`, but
+    instead of querying for each author in turn the counts for every author
+    are computed at once and merged as the results are streamed back.
+
+    The requests counted can be limited to those with an id greater than
+    ``since`` and no greater than ``until``. When ``since`` is given only
+    the authors with requests in that range are generated, and their
+    downloads, countries and dates contain just the counts for the new
+    requests. These can be added to a previous summary using
+    :func:`merge`.
+    """
+
+    author_id = documents_authors.c.author_id
+    requests_to_authors = requests.join(documents_authors,
+        requests.c.document_id==documents_authors.c.document_id)
+    day = _day(requests.c.datetime)
+
+    entities = select([authors.c.id, authors.c.mit_id, authors.c.name])\
+               .order_by(authors.c.id)
+    countries = select([author_id, requests.c.country, func.count()])\
+                .select_from(requests_to_authors)\
+                .group_by(author_id, requests.c.country)\
+                .order_by(author_id, requests.c.country)
+    dates = select([author_id, day, func.count()])\
+            .select_from(requests_to_authors)\
+            .group_by(author_id, day)\
+            .order_by(author_id, day)
+    countries = _window(countries, since, until)
+    dates = _window(dates, since, until)
+    if since is not None:
+        touched = _window(select([author_id])
+                          .select_from(requests_to_authors), since, until)
+        entities = entities.where(authors.c.id.in_(touched))
+    return _author_objs(conn, entities, countries, dates)
+
+
+def rollup_author_objs(conn):
+    """
+    Generate all author objects from the ``author_downloads`` rollup.
+
+    The objects are the same as those from :func:`bulk_author_objs`, but
+    the counts are read from the rollup table instead of the requests.
+    """
+
+    entities = select([authors.c.id, authors.c.mit_id, authors.c.name])\
+               .order_by(authors.c.id)
+    countries, dates = _rollup_counts(author_downloads.c.author_id)
+    return _author_objs(conn, entities, countries, dates)
+
+
+def _author_objs(conn, entities, countries, dates):
+    author_id = documents_authors.c.author_id
+    sizes = select([author_id, func.count()])\
+            .group_by(author_id)\
+            .order_by(author_id)
+    for a, (size, country_rows, date_rows) in _merge(conn, entities, sizes,
+                                                     countries, dates):
+        author_obj = {'type': 'author'}
+        author_obj['_id'] = {'name': a['name'], 'mitid': a['mit_id']}
+        author_obj['size'] = size[0][1] if size else 0
+        author_obj['downloads'] = sum(row[2] for row in country_rows)
+        _add_counts(author_obj, country_rows, date_rows)
+        yield author_obj
+
+
+def bulk_dlc_objs(conn, since=None, until=None):
+    """
+    Generate all DLC objects using a fixed number of grouped queries.
+
+    See :func:`bulk_author_objs`.
+    """
+
+    dlc_id = documents_dlcs.c.dlc_id
+    requests_to_dlcs = requests.join(documents_dlcs,
+        requests.c.document_id==documents_dlcs.c.document_id)
+    day = _day(requests.c.datetime)
+
+    entities = select([dlcs.c.id, dlcs.c.canonical_name, dlcs.c.display_name])\
+               .order_by(dlcs.c.id)
+    countries = select([dlc_id, requests.c.country, func.count()])\
+                .select_from(requests_to_dlcs)\
+                .group_by(dlc_id, requests.c.country)\
+                .order_by(dlc_id, requests.c.country)
+    dates = select([dlc_id, day, func.count()])\
+            .select_from(requests_to_dlcs)\
+            .group_by(dlc_id, day)\
+            .order_by(dlc_id, day)
+    countries = _window(countries, since, until)
+    dates = _window(dates, since, until)
+    if since is not None:
+        touched = _window(select([dlc_id])
+                          .select_from(requests_to_dlcs), since, until)
+        entities = entities.where(dlcs.c.id.in_(touched))
+    return _dlc_objs(conn, entities, countries, dates)
+
+
+def rollup_dlc_objs(conn):
+    """
+    Generate all DLC objects from the ``dlc_downloads`` rollup.
+
+    See :func:`rollup_author_objs`.
+    """
+
+    entities = select([dlcs.c.id, dlcs.c.canonical_name, dlcs.c.display_name])\
+               .order_by(dlcs.c.id)
+    countries, dates = _rollup_counts(dlc_downloads.c.dlc_id)
+    return _dlc_objs(conn, entities, countries, dates)
+
+
+def _dlc_objs(conn, entities, countries, dates):
+    dlc_id = documents_dlcs.c.dlc_id
+    sizes = select([dlc_id, func.count()])\
+            .group_by(dlc_id)\
+            .order_by(dlc_id)
+    for d, (size, country_rows, date_rows) in _merge(conn, entities, sizes,
+                                                     countries, dates):
+        dlc_obj = {'type': 'dlc'}
+        dlc_obj['_id'] = {'canonical': d['canonical_name'],
+                          'display': d['display_name']}
+        dlc_obj['size'] = size[0][1] if size else 0
+        dlc_obj['downloads'] = sum(row[2] for row in country_rows)
+        _add_counts(dlc_obj, country_rows, date_rows)
+        yield dlc_obj
+
+
+def bulk_handle_objs(conn, since=None, until=None):
+    """
+    Generate all handle objects using a fixed number of grouped queries.
+
+    See :func:`bulk_author_objs`.
+    """
+
+    doc_id = requests.c.document_id
+    day = _day(requests.c.datetime)
+
+    entities = select([documents.c.id, documents.c.handle,
+                       documents.c.title])\
+               .order_by(documents.c.id)
+    countries = select([doc_id, requests.c.country, func.count()])\
+                .group_by(doc_id, requests.c.country)\
+                .order_by(doc_id, requests.c.country)
+    dates = select([doc_id, day, func.count()])\
+            .group_by(doc_id, day)\
+            .order_by(doc_id, day)
+    countries = _window(countries, since, until)
+    dates = _window(dates, since, until)
+    if since is not None:
+        touched = _window(select([doc_id]), since, until)
+        entities = entities.where(documents.c.id.in_(touched))
+    return _handle_objs(conn, entities, countries, dates)
+
+
+def rollup_handle_objs(conn):
+    """
+    Generate all handle objects from the ``document_downloads`` rollup.
+
+    See :func:`rollup_author_objs`.
+    """
+
+    entities = select([documents.c.id, documents.c.handle,
+                       documents.c.title])\
+               .order_by(documents.c.id)
+    countries, dates = _rollup_counts(document_downloads.c.document_id)
+    return _handle_objs(conn, entities, countries, dates)
+
+
+def _handle_objs(conn, entities, countries, dates):
+    parents = select([documents_authors.c.document_id, authors.c.name,
+                      authors.c.mit_id])\
+              .select_from(authors.join(documents_authors))\
+              .order_by(documents_authors.c.document_id,
+                        documents_authors.c.id)
+    for d, (parent_rows, country_rows, date_rows) in \
+            _merge(conn, entities, parents, countries, dates):
+        handle_obj = {'type': 'handle'}
+        handle_obj['_id'] = d['handle']
+        handle_obj['title'] = d['title']
+        handle_obj['downloads'] = sum(row[2] for row in country_rows)
+        for row in parent_rows:
+            handle_obj.setdefault('parents', [])\
+                .append({'mitid': row[2], 'name': row[1]})
+        _add_counts(handle_obj, country_rows, date_rows)
+        yield handle_obj
+
+
+def merge(existing, delta):
+    """
+    Add the counts from ``delta`` to an ``existing`` summary object.
+
+    Downloads, countries and dates are summed. Every other field is taken
+    from ``delta``, which is expected to be freshly generated.
+    """
+
+    if existing is None:
+        return delta
+    obj = dict(delta)
+    obj['downloads'] = existing.get('downloads', 0) + delta['downloads']
+    for field, key in (('countries', 'country'), ('dates', 'date')):
+        counts = {}
+        for item in existing.get(field, []) + delta.get(field, []):
+            counts[item[key]] = counts.get(item[key], 0) + item['downloads']
+        if counts:
+            obj[field] = [{key: k, 'downloads': counts[k]} for k in
+                          sorted(counts, key=lambda k: (k is None, k))]
+    return obj
+
+
+def merged(collection, objs, size=1000):
+    """Merge summary objects with the versions already in ``collection``."""
+    while True:
+        chunk = list(islice(objs, size))
+        if not chunk:
+            break
+        ids = [obj['_id'] for obj in chunk]
+        existing = {}
+        for obj in collection.find({'_id': {'$in': ids}}):
+            existing[_key(obj['_id'])] = obj
+        for obj in chunk:
+            yield merge(existing.get(_key(obj['_id'])), obj)
+
+
+def get_watermark(conn, collection):
+    """Return the id of the last request summarized into ``collection``."""
+
+    return conn.scalar(select([summary_watermarks.c.request_id])
+                       .where(summary_watermarks.c.collection==collection))
+
+
+def set_watermark(conn, collection, request_id, datetime):
+    with conn.begin():
+        conn.execute(summary_watermarks.delete()
+                     .where(summary_watermarks.c.collection==collection))
+        conn.execute(summary_watermarks.insert(), collection=collection,
+                     request_id=request_id, datetime=datetime)
+
+
+def _window(query, since, until):
+    if since is not None:
+        query = query.where(requests.c.id > since)
+    if until is not None:
+        query = query.where(requests.c.id <= until)
+    return query
+
+
+def _key(_id):
+    if isinstance(_id, dict):
+        return tuple(sorted(_id.items()))
+    return _id
+
+
+def _merge(conn, entities, *queries):
+    """
+    Pair each entity row with its rows from each of the grouped queries.
+
+    The first column of every query must be the entity id and all of the
+    queries, including ``entities``, must be ordered by it. Results are
+    streamed from the database so only one entity's rows are held in
+    memory at a time.
+    """
+
+    streaming = conn.execution_options(stream_results=True)
+    groups = [groupby(streaming.execute(q), itemgetter(0)) for q in queries]
+    heads = [next(g, None) for g in groups]
+    for entity in streaming.execute(entities):
+        rows = []
+        for i, group in enumerate(groups):
+            while heads[i] is not None and heads[i][0] < entity[0]:
+                heads[i] = next(group, None)
+            if heads[i] is not None and heads[i][0] == entity[0]:
+                rows.append(list(heads[i][1]))
+                heads[i] = next(group, None)
+            else:
+                rows.append([])
+        yield entity, rows
+
+
+def _day(column):
+    """Truncate ``column`` to the start of its day."""
+    return func.date_trunc('day', column, type_=DateTime)
+
+
+def _rollup_counts(column):
+    """Return the grouped country and date queries for a rollup table."""
+
+    table = column.table
+    country = func.nullif(table.c.country, '')
+    countries = select([column, country, func.sum(table.c.downloads)])\
+                .group_by(column, country)\
+                .order_by(column, country)
+    dates = select([column, table.c.date, func.sum(table.c.downloads)])\
+            .group_by(column, table.c.date)\
+            .order_by(column, table.c.date)
+    return countries, dates
+
+
+def _add_counts(obj, countries, dates):
+    for row in countries:
+        obj.setdefault('countries', [])\
+            .append({'country': row[1], 'downloads': row[2]})
+    for row in dates:
+        obj.setdefault('dates', [])\
+            .append({'date': row[1].strftime('%Y-%m-%d'),
+                     'downloads': row[2]})
@@ -1,19 +1,26 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 import io
+import json
 import os
 
 import geoip2.database
+import maxminddb
 import maxminddb.const
+import pymongo
 import pytest
+from sqlalchemy import create_engine
 
-from pipeline.cache import region
+from pipeline.cache import identities, region
 from pipeline.db import engine, metadata
+from pipeline.schema import drop_tables
 
 
-@pytest.fixture(autouse=True)
+@pytest.yield_fixture(autouse=True)
 def clear_cache():
     region.invalidate()
+    yield
+    identities.close()
 
 
 @pytest.yield_fixture
@@ -25,6 +32,36 @@ def db():
     metadata.drop_all()
 
 
+@pytest.yield_fixture
+def postgres():
+    """
+    A connection to the PostGres database named by the
+    ``OASTATS_TEST_POSTGRES`` environment variable. The tables created in
+    it are dropped afterwards. Tests using this are skipped if it isn't
+    set.
+    """
+
+    url = os.environ.get('OASTATS_TEST_POSTGRES')
+    if not url:
+        pytest.skip('OASTATS_TEST_POSTGRES is not set')
+    conn = create_engine(url).connect()
+    yield conn
+    drop_tables(conn)
+    conn.close()
+
+
+@pytest.fixture
+def collection(tmpdir):
+    return Database(str(tmpdir.join('mongo.jsonl')))['summary']
+
+
+@pytest.fixture
+def mongo(monkeypatch, collection):
+    monkeypatch.setattr(pymongo, 'MongoClient',
+                        lambda uri: {'oastats': collection.database})
+    return collection.database
+
+
 @pytest.fixture
 def geolite_db():
     return os.path.join(_current_dir(), 'fixtures/GeoLite2-Country.mmdb')
@@ -38,6 +75,13 @@ def geolite(geolite_db):
     reader.close()
 
 
+@pytest.yield_fixture
+def geolite_raw(geolite_db):
+    reader = maxminddb.open_database(geolite_db, maxminddb.const.MODE_AUTO)
+    yield reader
+    reader.close()
+
+
 @pytest.fixture
 def log_file():
     return os.path.join(_current_dir(), 'fixtures/requests.log')
@@ -69,5 +113,76 @@ def id_req():
     }
 
 
+class Collection(object):
+    """
+    An in memory Mongo collection which records the calls made to it.
+
+    Objects written to the collection are also appended to the database's
+    log file, so that those written by other processes can be read back
+    with ``logged``.
+    """
+
+    def __init__(self, name, database):
+        self.name = name
+        self.database = database
+        self.calls = []
+        self.docs = {}
+
+    def bulk_write(self, requests, ordered=True):
+        self.calls.append(('bulk_write', len(requests), ordered))
+        objs = [request._doc['$set'] for request in requests]
+        for obj in objs:
+            self.docs.setdefault(_key(obj['_id']), {}).update(obj)
+        self._log(objs)
+
+    def insert_many(self, documents, ordered=True):
+        self.calls.append(('insert_many', len(documents), ordered))
+        for obj in documents:
+            self.docs[_key(obj['_id'])] = dict(obj)
+        self._log(documents)
+
+    def logged(self):
+        with io.open(self.database.path, encoding='utf-8') as fp:
+            return [obj for name, obj in (json.loads(line) for line in fp)
+                    if name == self.name]
+
+    def find(self, spec=None):
+        if spec is None:
+            return list(self.docs.values())
+        keys = [_key(_id) for _id in spec['_id']['$in']]
+        return [self.docs[k] for k in keys if k in self.docs]
+
+    def find_one(self, spec):
+        return self.docs.get(_key(spec['_id']))
+
+    def rename(self, new_name, dropTarget=False):
+        self.calls.append(('rename', new_name, dropTarget))
+        self.database[new_name].docs = self.docs
+        self.docs = {}
+
+    def drop(self):
+        self.calls.append(('drop',))
+        self.docs = {}
+
+    def _log(self, objs):
+        with io.open(self.database.path, 'a', encoding='utf-8') as fp:
+            for obj in objs:
+                fp.write(u'{}\n'.format(json.dumps([self.name, obj])))
+
+
+class Database(dict):
+    def __init__(self, path):
+        super(Database, self).__init__()
+        self.path = path
+
+    def __missing__(self, name):
+        self[name] = Collection(name, self)
+        return self[name]
+
+
+def _key(_id):
+    return json.dumps(_id, sort_keys=True)
+
+
 def _current_dir():
     return os.path.dirname(os.path.realpath(__file__))
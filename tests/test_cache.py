@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import time
+
+from pipeline.cache import (NO_VALUE, IdentityCache, LRUCache, Region,
+                            make_key)
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+
+
+def test_lru_cache_counts_hits_and_misses():
+    cache = LRUCache(2)
+    cache.get('a')
+    cache.set('a', 1)
+    cache.get('a')
+    cache.get('a')
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_identity_cache_persists_identities(tmpdir):
+    path = str(tmpdir.join('identities.db'))
+    cache = IdentityCache()
+    cache.configure(path)
+    cache.set('1721.1/1', {'success': True})
+    cache.close()
+    cache.configure(path)
+    assert cache.get('1721.1/1') == {'success': True}
+    assert cache.get('1721.1/2') is NO_VALUE
+
+
+def test_identity_cache_expires_identities(tmpdir, monkeypatch):
+    cache = IdentityCache()
+    cache.configure(str(tmpdir.join('identities.db')), ttl=100,
+                    negative_ttl=10)
+    cache.set('1721.1/1', {'success': True})
+    cache.set('1721.1/2', None)
+    cache.set('1721.1/3', {'success': False})
+    assert cache.get('1721.1/2') is None
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 50)
+    assert cache.get('1721.1/1') == {'success': True}
+    assert cache.get('1721.1/2') is NO_VALUE
+    assert cache.get('1721.1/3') is NO_VALUE
+    monkeypatch.setattr(time, 'time', lambda: now + 150)
+    assert cache.get('1721.1/1') is NO_VALUE
+
+
+def test_identity_cache_ignores_identities_until_configured():
+    cache = IdentityCache()
+    cache.set('1721.1/1', {'success': True})
+    assert cache.get('1721.1/1') is NO_VALUE
+
+
+def test_lru_cache_counts_evictions():
+    cache = LRUCache(2)
+    for key in 'abc':
+        cache.set(key, 1)
+    cache.resize(1)
+    assert cache.evictions == 2
+    assert len(cache) == 1
+
+
+def test_region_caches_functions_separately():
+    region = Region(10)
+    calls = []
+
+    @region.cache_on_arguments()
+    def foo(key):
+        calls.append(key)
+        return 'foo' + key
+
+    @region.cache_on_arguments()
+    def bar(key):
+        return 'bar' + key
+    assert foo('a') == foo('a') == 'fooa'
+    assert bar('a') == 'bara'
+    assert calls == ['a']
+    assert list(region.caches) == ['foo', 'bar']
+
+
+def test_region_bounds_function_caches():
+    region = Region(2)
+
+    @region.cache_on_arguments()
+    def foo(key):
+        return key
+    for key in 'abc':
+        foo(key)
+    assert foo.get('a') is NO_VALUE
+    assert region.stats() == ['foo: 2 items, 0 hits, 4 misses, 1 evictions']
+
+
+def test_region_get_and_set_use_function_cache():
+    region = Region(2)
+
+    @region.cache_on_arguments()
+    def foo(key, conn):
+        raise AssertionError
+    foo.set(1, {'a': 1, 'b': 2}, None)
+    assert foo.get({'b': 2, 'a': 1}, None) == 1
+    assert foo({'b': 2, 'a': 1}, None) == 1
+    region.invalidate()
+    assert foo.get({'a': 1, 'b': 2}) is NO_VALUE
+
+
+def test_make_key_is_stable_for_dicts():
+    assert make_key({'mitid': '1', 'name': 'Foo'}) == \
+        make_key(dict([('name', 'Foo'), ('mitid', '1')]))
+    assert make_key('1721.1/1') == '1721.1/1'
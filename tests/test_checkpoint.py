@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import gzip
+import io
+
+import pytest
+
+from pipeline.checkpoint import (Checkpoint, CheckpointError, Segment,
+                                 count_lines)
+
+
+@pytest.fixture
+def state(tmpdir):
+    return Checkpoint(str(tmpdir.join('state.json')), 'identities.db')
+
+
+def test_checkpoint_saves_and_loads_state(state):
+    state.files['foo.log'] = {'offset': 10, 'line': 1}
+    state.save()
+    loaded = Checkpoint.load(state.path)
+    assert loaded.files == {'foo.log': {'offset': 10, 'line': 1}}
+    assert loaded.identity_cache == 'identities.db'
+
+
+def test_checkpoint_load_raises_error_for_missing_file(tmpdir):
+    with pytest.raises(CheckpointError):
+        Checkpoint.load(str(tmpdir.join('missing.json')))
+
+
+def test_checkpoint_advances_through_segments(state, log_file, logs):
+    for segment in state.segments([log_file], 200):
+        list(segment)
+        state.advance(segment)
+    with io.open(log_file, 'rb') as fp:
+        length = len(fp.read())
+    assert state.files[log_file] == {'offset': length,
+                                     'line': len(logs.readlines())}
+    assert list(state.segments([log_file], 200)) == []
+
+
+def test_checkpoint_resumes_from_offset(state, log_file, logs):
+    segments = list(state.segments([log_file], 200))
+    list(segments[0])
+    state.advance(segments[0])
+    resumed = [l for s in state.segments([log_file], 200) for l in s]
+    assert resumed == logs.readlines()[segments[0].lines:]
+
+
+def test_checkpoint_reads_compressed_files_whole(state, log_file, tmpdir):
+    path = str(tmpdir.join('requests.log.gz'))
+    with io.open(log_file, 'rb') as fp, gzip.open(path, 'wb') as out:
+        out.write(fp.read())
+    segments = list(state.segments([path], 200))
+    assert len(segments) == 1
+    assert segments[0].compressed
+
+
+def test_checkpoint_raises_error_for_truncated_file(state, log_file):
+    state.files[log_file] = {'offset': 10 ** 9, 'line': 0}
+    with pytest.raises(CheckpointError):
+        list(state.segments([log_file]))
+
+
+def test_segment_counts_lines_read_with_mmap(log_file, logs):
+    with io.open(log_file, 'rb') as fp:
+        length = len(fp.read())
+    segment = Segment(log_file, 0, length, use_mmap=True)
+    list(segment)
+    assert segment.lines == len(logs.readlines())
+
+
+def test_count_lines_counts_last_line_without_newline(tmpdir):
+    path = tmpdir.join('requests.log')
+    path.write_binary(b'foo\nbar\nbaz')
+    assert count_lines(str(path), 0, 11) == 3
+    assert count_lines(str(path), 4, 8) == 1
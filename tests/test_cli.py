@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
+from contextlib import closing
+import gzip
+import io
 
 from click.testing import CliRunner
 import pytest
 import requests_mock
+from sqlalchemy.sql import func, select
 
+from pipeline import cli
+from pipeline.cache import identities, region
 from pipeline.cli import main
+from pipeline.db import document_downloads, engine, requests
 
 
 pytestmark = pytest.mark.usefixtures('db')
@@ -46,3 +53,260 @@ def test_pipeline_reads_from_stdin(geolite_db, logs):
                              input=logs.read())
     assert res.exit_code == 0
     assert len(res.output.strip().split('\n')) == 3
+
+
+def test_pipeline_parses_in_parallel(geolite_db, log_file):
+    args = ['pipeline', '--geo-ip', geolite_db, '--dspace',
+            'mock://example.com/ws/', '--database', 'sqlite://', log_file]
+    serial = CliRunner().invoke(main, args)
+    parallel = CliRunner().invoke(main, args + ['--workers', '2'])
+    assert parallel.exit_code == 0
+    assert parallel.output == serial.output
+
+
+def test_pipeline_uses_fused_engine(geolite_db, log_file):
+    args = ['pipeline', '--geo-ip', geolite_db, '--dspace',
+            'mock://example.com/ws/', '--database', 'sqlite://', log_file]
+    compose = CliRunner().invoke(main, args)
+    fused = CliRunner().invoke(main, args + ['--engine', 'fused'])
+    assert fused.exit_code == 0
+    assert fused.output == compose.output
+
+
+def test_pipeline_uses_raw_geo_reader(geolite_db, log_file):
+    args = ['pipeline', '--geo-ip', geolite_db, '--dspace',
+            'mock://example.com/ws/', '--database', 'sqlite://', log_file]
+    geoip2 = CliRunner().invoke(main, args)
+    raw = CliRunner().invoke(main, args + ['--geo-reader', 'maxminddb'])
+    assert raw.exit_code == 0
+    assert raw.output == geoip2.output
+
+
+def test_pipeline_fetches_identities_concurrently(geolite_db, log_file):
+    args = ['pipeline', '--geo-ip', geolite_db, '--dspace',
+            'mock://example.com/ws/', '--database', 'sqlite://', log_file]
+    serial = CliRunner().invoke(main, args)
+    concurrent = CliRunner().invoke(main, args + ['--dspace-concurrency', '4'])
+    assert concurrent.exit_code == 0
+    assert concurrent.output == serial.output
+
+
+def test_pipeline_uses_identity_cache(geolite_db, log_file, dspace, tmpdir):
+    args = ['pipeline', '--geo-ip', geolite_db, '--dspace',
+            'mock://example.com/ws/', '--database', 'sqlite://',
+            '--identity-cache', str(tmpdir.join('identities.db')), log_file]
+    first = CliRunner().invoke(main, args)
+    region.invalidate()
+    second = CliRunner().invoke(main, args)
+    assert second.exit_code == 0
+    assert second.output == first.output
+    assert dspace.call_count == 1
+
+
+def test_pipeline_closes_identity_cache_on_error(geolite_db, log_file,
+                                                 tmpdir, monkeypatch):
+    def fail(*args):
+        raise ValueError
+    monkeypatch.setattr(cli, 'write_requests', fail)
+    res = CliRunner().invoke(main, ['pipeline', '--geo-ip', geolite_db,
+                                    '--dspace', 'mock://example.com/ws/',
+                                    '--database', 'sqlite://',
+                                    '--identity-cache',
+                                    str(tmpdir.join('identities.db')),
+                                    log_file])
+    assert isinstance(res.exception, ValueError)
+    assert identities._conn is None
+
+
+def test_pipeline_prefetches_identities(geolite_db, log_file, dspace):
+    args = ['pipeline', '--geo-ip', geolite_db, '--dspace',
+            'mock://example.com/ws/', '--database', 'sqlite://', log_file]
+    serial = CliRunner().invoke(main, args)
+    region.invalidate()
+    dspace.reset_mock()
+    prefetched = CliRunner().invoke(main, args + ['--prefetch'])
+    assert prefetched.exit_code == 0
+    # The progress bar on STDERR is mixed into the output before the rows.
+    assert prefetched.output.endswith(serial.output)
+    assert serial.output
+    assert dspace.call_count == 1
+
+
+def test_pipeline_prefetch_requires_files(geolite_db, logs):
+    res = CliRunner().invoke(main, ['pipeline', '--geo-ip', geolite_db,
+                                    '--dspace', 'mock://example.com/ws/',
+                                    '--database', 'sqlite://', '--prefetch'],
+                             input=logs.read())
+    assert res.exit_code == 2
+
+
+def test_pipeline_preloads_ids(geolite_db, log_file):
+    args = ['pipeline', '--geo-ip', geolite_db, '--dspace',
+            'mock://example.com/ws/', '--database', 'sqlite://', log_file]
+    first = CliRunner().invoke(main, args)
+    preloaded = CliRunner().invoke(main, args + ['--preload'])
+    assert preloaded.exit_code == 0
+    assert preloaded.output == first.output
+
+
+def test_pipeline_copy_sink_requires_postgres(geolite_db, log_file):
+    res = CliRunner().invoke(main, ['pipeline', '--geo-ip', geolite_db,
+                                    '--dspace', 'mock://example.com/ws/',
+                                    '--database', 'sqlite://', '--sink',
+                                    'copy', log_file])
+    assert res.exit_code == 2
+
+
+def test_pipeline_reads_compressed_logs(geolite_db, log_file, tmpdir):
+    path = str(tmpdir.join('requests.log.gz'))
+    with io.open(log_file, 'rb') as fp, gzip.open(path, 'wb') as out:
+        out.write(fp.read())
+    args = ['pipeline', '--geo-ip', geolite_db, '--dspace',
+            'mock://example.com/ws/', '--database', 'sqlite://']
+    plain = CliRunner().invoke(main, args + [log_file])
+    compressed = CliRunner().invoke(main, args + [path])
+    parallel = CliRunner().invoke(main, args + ['-w', '2', path])
+    assert compressed.exit_code == 0
+    assert compressed.output == plain.output
+    assert parallel.output == plain.output
+
+
+def test_pipeline_uses_mmap_log_reader(geolite_db, log_file):
+    args = ['pipeline', '--geo-ip', geolite_db, '--dspace',
+            'mock://example.com/ws/', '--database', 'sqlite://', log_file]
+    lines = CliRunner().invoke(main, args)
+    mapped = CliRunner().invoke(main, args + ['--log-reader', 'mmap'])
+    parallel = CliRunner().invoke(main, args + ['--log-reader', 'mmap',
+                                                '-w', '2'])
+    assert mapped.exit_code == 0
+    assert mapped.output == lines.output
+    assert parallel.output == lines.output
+
+
+def test_pipeline_resumes_from_checkpoint(geolite_db, log_file, tmpdir,
+                                          monkeypatch):
+    state = str(tmpdir.join('state.json'))
+    args = ['pipeline', '--geo-ip', geolite_db, '--dspace',
+            'mock://example.com/ws/', '--database', 'sqlite://', log_file]
+    expected = CliRunner().invoke(main, args).output
+    calls = []
+
+    def write_requests(reqs, resolver, output):
+        if len(calls) == 2:
+            raise IOError('DSpace is down')
+        calls.append(reqs)
+        cli.write_requests.original(reqs, resolver, output)
+    write_requests.original = cli.write_requests
+    monkeypatch.setattr(cli, 'write_requests', write_requests)
+    args += ['--checkpoint', state, '--checkpoint-size', '0.0002']
+    failed = CliRunner().invoke(main, args)
+    assert failed.exit_code != 0
+    assert 0 < len(failed.output) < len(expected)
+    monkeypatch.undo()
+    region.invalidate()
+    resumed = CliRunner().invoke(main, args + ['--resume'])
+    assert resumed.exit_code == 0
+    assert failed.output + resumed.output == expected
+
+
+def test_pipeline_resume_requires_checkpoint(geolite_db, log_file):
+    res = CliRunner().invoke(main, ['pipeline', '--geo-ip', geolite_db,
+                                    '--dspace', 'mock://example.com/ws/',
+                                    '--database', 'sqlite://', '--resume',
+                                    log_file])
+    assert res.exit_code == 2
+
+
+def append(path, data):
+    with io.open(str(path), 'ab') as fp:
+        fp.write(data)
+
+
+def test_follow_loads_new_requests(geolite_db, log_file, tmpdir):
+    log = tmpdir.join('access.log')
+    with io.open(log_file, 'rb') as fp:
+        lines = fp.readlines()
+    expected = CliRunner().invoke(main, ['pipeline', '--geo-ip', geolite_db,
+                                         '--dspace', 'mock://example.com/ws/',
+                                         '--database', 'sqlite://',
+                                         log_file]).output
+    args = ['follow', '--geo-ip', geolite_db, '--dspace',
+            'mock://example.com/ws/', '--database', 'sqlite://', '--state',
+            str(tmpdir.join('state.json')), '--once', str(log)]
+    count = select([func.count()]).select_from(requests)
+    with closing(engine().connect()) as conn:
+        log.write_binary(b''.join(lines[:3]))
+        assert CliRunner().invoke(main, args).exit_code == 0
+        assert 0 < conn.scalar(count) < len(expected.splitlines())
+        append(log, b''.join(lines[3:]))
+        assert CliRunner().invoke(main, args).exit_code == 0
+        assert conn.scalar(count) == len(expected.splitlines())
+
+
+def test_follow_discards_interrupted_batch(geolite_db, log_file, tmpdir,
+                                          monkeypatch):
+    args = ['follow', '--geo-ip', geolite_db, '--dspace',
+            'mock://example.com/ws/', '--database', 'sqlite://', '--state',
+            str(tmpdir.join('state.json')), '--once', log_file]
+    expected = CliRunner().invoke(main, ['pipeline', '--geo-ip', geolite_db,
+                                         '--dspace', 'mock://example.com/ws/',
+                                         '--database', 'sqlite://',
+                                         log_file]).output
+    write_requests = cli.write_requests
+
+    def interrupted(reqs, resolver, output):
+        write_requests(reqs, resolver, output)
+        raise KeyboardInterrupt
+
+    count = select([func.count()]).select_from(requests)
+    with closing(engine().connect()) as conn:
+        monkeypatch.setattr(cli, 'write_requests', interrupted)
+        assert CliRunner().invoke(main, args).exit_code == 0
+        assert conn.scalar(count) == 0
+        monkeypatch.undo()
+        assert CliRunner().invoke(main, args).exit_code == 0
+        assert conn.scalar(count) == len(expected.splitlines())
+
+
+def test_follow_updates_rollups(geolite_db, log_file):
+    res = CliRunner().invoke(main, ['follow', '--geo-ip', geolite_db,
+                                    '--dspace', 'mock://example.com/ws/',
+                                    '--database', 'sqlite://', '--once',
+                                    '--rollups', log_file])
+    assert res.exit_code == 0
+    downloads = select([func.sum(document_downloads.c.downloads)])
+    with closing(engine().connect()) as conn:
+        counted = conn.scalar(downloads)
+        assert counted == conn.scalar(select([func.count()])
+                                      .select_from(requests))
+        res = CliRunner().invoke(main, ['rollup', '--database', 'sqlite://',
+                                        '--start', '2000-01-01'])
+        assert res.exit_code == 0
+        assert conn.scalar(downloads) == counted
+
+
+def test_pipeline_rollups_require_database_sink(geolite_db, log_file):
+    res = CliRunner().invoke(main, ['pipeline', '--geo-ip', geolite_db,
+                                    '--dspace', 'mock://example.com/ws/',
+                                    '--database', 'sqlite://', '--rollups',
+                                    log_file])
+    assert res.exit_code == 2
+
+
+def test_pipeline_insert_sink_updates_rollups(geolite_db, log_file):
+    res = CliRunner().invoke(main, ['pipeline', '--geo-ip', geolite_db,
+                                    '--dspace', 'mock://example.com/ws/',
+                                    '--database', 'sqlite://', '--sink',
+                                    'insert', '--rollups', log_file])
+    assert res.exit_code == 0
+    with closing(engine().connect()) as conn:
+        count = conn.scalar(select([func.count()]).select_from(requests))
+        assert count > 0
+        downloads = select([func.sum(document_downloads.c.downloads)])
+        assert conn.scalar(downloads) == count
+
+
+def test_summary_jobs_cannot_be_used_with_bulk():
+    res = CliRunner().invoke(main, ['summary', '--database', 'sqlite://',
+                                    '--bulk', '--jobs', '2'])
+    assert res.exit_code == 2
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import io
+import os
+
+import pytest
+
+from pipeline.follow import Follower, micro_batches
+
+
+def append(path, data):
+    with io.open(str(path), 'ab') as fp:
+        fp.write(data)
+
+
+@pytest.fixture
+def log(tmpdir):
+    path = tmpdir.join('access.log')
+    path.write_binary(b'')
+    return path
+
+
+def test_follower_returns_new_lines(log):
+    follower = Follower(str(log))
+    assert follower.read() == []
+    append(log, b'foo\nbar\n')
+    assert follower.read() == ['foo\n', 'bar\n']
+    append(log, b'baz\n')
+    assert follower.read() == ['baz\n']
+    assert (follower.offset, follower.line) == (12, 3)
+
+
+def test_follower_holds_back_partial_lines(log):
+    follower = Follower(str(log))
+    append(log, b'foo\nba')
+    assert follower.read() == ['foo\n']
+    append(log, b'r\n')
+    assert follower.read() == ['bar\n']
+
+
+def test_follower_reads_in_blocks(log):
+    follower = Follower(str(log), block=8)
+    append(log, b'foo\nbar\nbaz\n')
+    assert follower.read() == ['foo\n', 'bar\n']
+    assert follower.read() == ['baz\n']
+
+
+def test_follower_follows_rotated_files(log):
+    follower = Follower(str(log))
+    append(log, b'foo\n')
+    assert follower.read() == ['foo\n']
+    append(log, b'bar\n')
+    os.rename(str(log), str(log) + '.1')
+    log.write_binary(b'baz\n')
+    assert follower.read() == ['bar\n', 'baz\n']
+    assert (follower.offset, follower.line) == (4, 1)
+
+
+def test_follower_rereads_truncated_files(log):
+    follower = Follower(str(log))
+    append(log, b'foo\nbar\n')
+    follower.read()
+    log.write_binary(b'baz\n')
+    assert follower.read() == ['baz\n']
+
+
+def test_follower_starts_from_saved_offset(log):
+    log.write_binary(b'foo\nbar\n')
+    inode = os.stat(str(log)).st_ino
+    assert Follower(str(log), 4, 1, inode).read() == ['bar\n']
+    assert Follower(str(log), 4, 1, inode + 1).read() == ['foo\n', 'bar\n']
+
+
+def test_micro_batches_limits_batch_size(log):
+    log.write_binary(b'foo\nbar\nbaz\n')
+    followers = [Follower(str(log), block=4)]
+    assert list(micro_batches(followers, size=2, once=True)) == \
+        [['foo\n', 'bar\n'], ['baz\n']]
+
+
+def test_micro_batches_stops_when_once(log):
+    assert list(micro_batches([Follower(str(log))], once=True)) == []
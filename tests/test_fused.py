@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import pickle
+
+import pytest
+import requests
+import requests_mock
+
+from pipeline.fused import (Request, construct_fused_parser,
+                            construct_fused_pipeline)
+from pipeline.pipeline import construct_parser, construct_pipeline
+
+
+@pytest.yield_fixture
+def session():
+    with requests.Session() as s:
+        yield s
+
+
+def test_request_supports_dict_access():
+    r = Request(range(11))
+    r['country'] = 'USA'
+    assert r['remote_host'] == 0
+    assert r.get('country') == 'USA'
+    assert r.get('handle', 'foo') == 'foo'
+    with pytest.raises(KeyError):
+        r['title']
+
+
+def test_request_can_be_pickled():
+    r = Request(range(11))
+    r.country = 'USA'
+    assert pickle.loads(pickle.dumps(r)).as_dict() == r.as_dict()
+
+
+def test_fused_parser_matches_parser(geolite, logs):
+    lines = logs.readlines()
+    for dates in ([], ['Aug/2015', 'Oct/2015']):
+        fused = construct_fused_parser(geolite, dates)
+        parser = construct_parser(geolite, dates)
+        assert [r.as_dict() for r in fused(lines)] == list(parser(lines))
+
+
+def test_fused_pipeline_matches_pipeline(session, geolite, id_req, logs):
+    lines = logs.readlines()
+    with requests_mock.Mocker() as m:
+        m.get('mock://example.com', json=id_req)
+        fused = construct_fused_pipeline(session, geolite,
+                                         'mock://example.com', ['Aug/2015'])
+        pipeline = construct_pipeline(session, geolite,
+                                      'mock://example.com', ['Aug/2015'])
+        reqs = [r.as_dict() for r in fused(lines)]
+        assert len(reqs) == 2
+        assert reqs == list(pipeline(lines))
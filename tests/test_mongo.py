@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import pytest
+
+from pipeline.mongo import SummaryWriter
+
+
+def test_summary_writer_batches_upserts(collection):
+    with SummaryWriter(collection, batch_size=2) as writer:
+        for i in range(5):
+            writer.write({'_id': i})
+    assert collection.calls == [('bulk_write', 2, False),
+                                ('bulk_write', 2, False),
+                                ('bulk_write', 1, False)]
+
+
+def test_summary_writer_swaps_new_collection(collection):
+    with SummaryWriter(collection, batch_size=2, swap=True) as writer:
+        for i in range(3):
+            writer.write({'_id': i})
+    new = collection.database['summary_new']
+    assert new.calls == [('drop',), ('insert_many', 2, False),
+                         ('insert_many', 1, False),
+                         ('rename', 'summary', True)]
+    assert not collection.calls
+
+
+def test_summary_writer_does_not_swap_on_error(collection):
+    with pytest.raises(ValueError):
+        with SummaryWriter(collection, swap=True) as writer:
+            writer.write({'_id': 1})
+            raise ValueError
+    new = collection.database['summary_new']
+    assert ('rename', 'summary', True) not in new.calls
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import multiprocessing
+
+import pytest
+
+from pipeline.db import engine, authors, dlcs, documents
+from pipeline.parallel import (SummaryError, parse_parallel,
+                               summarize_parallel, summary_shards)
+from pipeline.pipeline import construct_parser
+
+
+def test_parse_parallel_preserves_order(geolite_db, geolite, log_file, logs):
+    reqs = list(parse_parallel([log_file], geolite_db, [], 2, size=200))
+    assert len(reqs) == 5
+    assert reqs == list(construct_parser(geolite, [])(logs))
+
+
+def test_parse_parallel_filters_by_date(geolite_db, log_file):
+    reqs = list(parse_parallel([log_file, log_file], geolite_db,
+                               ['Aug/2015'], 3, size=100))
+    assert len(reqs) == 4
+
+
+def test_parse_parallel_uses_fused_engine(geolite_db, geolite, log_file,
+                                          logs):
+    reqs = list(parse_parallel([log_file], geolite_db, [], 2, size=200,
+                               engine='fused'))
+    assert [r.as_dict() for r in reqs] == \
+        list(construct_parser(geolite, [])(logs))
+
+
+fork_only = pytest.mark.skipif(
+    getattr(multiprocessing, 'get_start_method', lambda: 'fork')() != 'fork',
+    reason='the fake Mongo client is only inherited by forked workers')
+
+
+def summarize_author(mit_id, conn):
+    return {'_id': mit_id, 'type': 'author'}
+
+
+def test_summary_shards_splits_entities(db):
+    conn = engine().connect()
+    conn.execute(authors.insert(), [{'mit_id': str(i), 'name': 'Foo'}
+                                    for i in range(5)])
+    conn.execute(dlcs.insert(), [{'canonical_name': 'Dept',
+                                  'display_name': 'Department'}])
+    assert summary_shards(conn, size=2) == [('author', ['0', '1']),
+                                            ('author', ['2', '3']),
+                                            ('author', ['4']),
+                                            ('dlc', [1])]
+
+
+@fork_only
+def test_summarize_parallel_writes_every_shard(mongo):
+    shards = [('author', list(range(i, i + 3))) for i in range(0, 30, 3)]
+    counts = list(summarize_parallel(shards, 'sqlite://', 'mongodb://',
+                                     'oastats', 'summary', 3, batch_size=2,
+                                     summaries={'author': summarize_author}))
+    assert sum(counts) == 30
+    objs = mongo['summary'].logged()
+    assert sorted(obj['_id'] for obj in objs) == list(range(30))
+
+
+def test_summarize_parallel_raises_shard_errors(mongo, tmpdir):
+    database = 'sqlite:///{}'.format(tmpdir.join('missing', 'oastats.db'))
+    with pytest.raises(SummaryError) as e:
+        list(summarize_parallel([('author', ['1234'])], database,
+                                'mongodb://', 'oastats', 'summary', 2))
+    assert 'author shard from 1234 to 1234' in str(e.value)
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import datetime
+
+from click.testing import CliRunner
+import pytest
+from sqlalchemy.sql import func, select
+
+from pipeline.cli import main
+from pipeline.db import engine, documents, document_downloads, requests
+from pipeline.partitions import (PartitionCreator, PartitionError,
+                                 add_months, create_partitions,
+                                 is_partitioned, month_of, months,
+                                 partition_name, truncate_month)
+from pipeline.schema import create_tables
+from pipeline.sink import InsertSink
+
+
+@pytest.yield_fixture
+def conn(db):
+    conn = engine().connect()
+    conn.execute(documents.insert(), [{'id': 1, 'handle': '1'}])
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def pg(postgres):
+    create_tables(postgres, partitioned=True)
+    postgres.execute(documents.insert(), [{'id': 1, 'handle': '1'}])
+    return postgres
+
+
+def add_requests(conn, times):
+    conn.execute(requests.insert(), [{'status': 200, 'datetime': time,
+                                      'document_id': 1} for time in times])
+
+
+def test_months_returns_first_days_of_months():
+    assert months(datetime.date(2015, 11, 15), datetime.date(2016, 2, 1)) == [
+        datetime.date(2015, 11, 1), datetime.date(2015, 12, 1),
+        datetime.date(2016, 1, 1), datetime.date(2016, 2, 1)]
+
+
+def test_add_months_wraps_years():
+    assert add_months(datetime.date(2015, 12, 1), 2) == \
+        datetime.date(2016, 2, 1)
+
+
+def test_month_of_returns_month_of_timestamp():
+    assert month_of('2015-08-31T23:59:59') == datetime.date(2015, 8, 1)
+
+
+def test_partition_name_includes_month():
+    assert partition_name(datetime.date(2015, 8, 1)) == 'requests_y2015m08'
+
+
+def test_partition_creator_ignores_unpartitioned_tables(conn):
+    create = PartitionCreator()
+    create(conn, [('200', 'USA', '/', '', '', '2015-08-31T00:00:00', '1')])
+    assert create.partitioned is False
+    assert not create.months
+
+
+def test_truncate_month_removes_requests_and_rollups(conn):
+    with InsertSink(engine(), rollups=True) as sink:
+        for time in ('2015-07-31T23:59:59', '2015-08-01T00:00:00',
+                     '2015-08-31T23:59:59', '2015-09-01T00:00:00'):
+            sink.write(('200', 'USA', '/', '', '', time, '1'))
+    truncate_month(conn, datetime.date(2015, 8, 1))
+    assert [r[0].month for r in
+            conn.execute(select([requests.c.datetime]))] == [7, 9]
+    assert conn.scalar(select([func.sum(document_downloads.c.downloads)])) \
+        == 2
+
+
+def test_db_partition_requires_postgres(db):
+    res = CliRunner().invoke(main, ['db', 'partition', '--database',
+                                    'sqlite://'])
+    assert res.exit_code == 2
+
+
+def test_db_truncate_requires_month(db):
+    res = CliRunner().invoke(main, ['db', 'truncate', '--database',
+                                    'sqlite://'])
+    assert res.exit_code == 2
+
+
+def test_create_tables_creates_partitioned_requests(pg):
+    assert is_partitioned(pg)
+    create_partitions(pg, [datetime.date(2015, 8, 1),
+                           datetime.date(2015, 9, 1)])
+    add_requests(pg, [datetime.datetime(2015, 8, 31, 23, 59, 59),
+                      datetime.datetime(2015, 9, 1)])
+    assert pg.execute('SELECT tableoid::regclass::text FROM requests '
+                      'ORDER BY datetime').fetchall() == \
+        [('requests_y2015m08',), ('requests_y2015m09',)]
+
+
+def test_truncate_month_truncates_partition(pg):
+    create_partitions(pg, [datetime.date(2015, 8, 1),
+                           datetime.date(2015, 9, 1)])
+    add_requests(pg, [datetime.datetime(2015, 8, 31),
+                      datetime.datetime(2015, 9, 1)])
+    truncate_month(pg, datetime.date(2015, 8, 1))
+    assert [r[0].month for r in
+            pg.execute(select([requests.c.datetime]))] == [9]
+
+
+def test_truncate_month_requires_partition(pg):
+    with pytest.raises(PartitionError):
+        truncate_month(pg, datetime.date(2015, 8, 1))
+
+
+def test_partition_creator_forgets_months_rolled_back(pg):
+    create = PartitionCreator()
+    rows = [('200', 'USA', '/', '', '', '2015-08-31T00:00:00', '1')]
+    trans = pg.begin()
+    create(pg, rows)
+    trans.rollback()
+    create.rollback()
+    create(pg, rows)
+    add_requests(pg, [datetime.datetime(2015, 8, 31)])
+    assert pg.scalar(select([func.count()]).select_from(requests)) == 1
@@ -1,15 +1,30 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
+import json
+import threading
+import time
 
+import arrow
 import pytest
 import requests
 import requests_mock
 
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from pipeline.cache import LRUCache, NO_VALUE, identities, region
 from pipeline.pipeline import (filter_by_date, filter_by_method, compose,
                                filter_by_ip, parse_into_dict, filter_bots,
                                filter_by_status, convert_datetime,
                                to_country, get_bitstream, add_identities,
-                               to_csv, construct_pipeline, add_country)
+                               to_csv, construct_pipeline, add_country,
+                               prefilter, to_iso_date, configure_session,
+                               fetch_identities, collect_handles,
+                               prefetch_identities)
 
 
 @pytest.yield_fixture
@@ -18,6 +33,42 @@ def session():
         yield s
 
 
+class DSpaceServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    delay = 0.1
+    failures = 0
+
+
+class DSpaceHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        if self.server.failures:
+            self.server.failures -= 1
+            self.send_response(503)
+            self.end_headers()
+            return
+        body = json.dumps({'success': True, 'uri': self.path}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.yield_fixture
+def dspace_server():
+    server = DSpaceServer(('127.0.0.1', 0), DSpaceHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
 def test_compose_returns_composed_func():
     f = compose(lambda x: x.upper(), lambda x: x + 'baz', lambda x, y: x+y)
     assert f('foo', 'bar') == 'FOOBARBAZ'
@@ -46,6 +97,21 @@ def test_filter_by_ip_filters(logs):
     assert all([l.startswith('18.1.1.1') for l in lines])
 
 
+def test_prefilter_matches_separate_filters(logs):
+    lines = logs.readlines()
+    filtered = filter_by_ip(filter_by_date(filter_by_method(lines),
+                                           ['Aug/2015', 'Sep/2015']))
+    assert list(prefilter(lines, ['Aug/2015', 'Sep/2015'])) == \
+        [l for l in filtered if '/openaccess-disseminate/' in l]
+
+
+def test_prefilter_removes_non_oa_requests():
+    lines = ['18.1.1.1 - - [31/Aug/2015:23:59:58 -0400] "GET /foo HTTP/1.1"',
+             '18.1.1.1 - - [31/Aug/2015:23:59:58 -0400] "GET '
+             '/openaccess-disseminate/1234.5/6789 HTTP/1.1"']
+    assert list(prefilter(lines)) == lines[1:]
+
+
 def test_parse_into_dict_returns_dicts(logs):
     reqs = list(parse_into_dict(logs))
     assert reqs[0]['request_url'] == '/openaccess-disseminate/1234.5/6789'
@@ -80,6 +146,26 @@ def test_convert_datetime_skips_invalid_dates():
     assert not list(reqs)
 
 
+def test_to_iso_date_matches_arrow():
+    for date in ('31/Aug/2015:23:59:59 -0400', '01/Jan/2016:00:00:00 +0000',
+                 '29/Feb/2016:12:30:05 -0000', '05/Mar/2016:08:15:00 +0530',
+                 '05/mar/2016:08:15:00 +0530'):
+        assert to_iso_date(date) == \
+            arrow.get(date, 'DD/MMM/YYYY:HH:mm:ss Z').isoformat()
+
+
+def test_to_iso_date_reuses_cached_minute():
+    assert to_iso_date('31/Aug/2015:23:59:01 -0400') == \
+        '2015-08-31T23:59:01-04:00'
+    assert to_iso_date('31/Aug/2015:23:59:02 -0400') == \
+        '2015-08-31T23:59:02-04:00'
+
+
+def test_to_iso_date_raises_parser_error_for_invalid_dates():
+    with pytest.raises(arrow.parser.ParserError):
+        to_iso_date('31/Aug/2015:23:59:5x -0400')
+
+
 def test_to_country_converts_ip_to_country_code(geolite):
     assert to_country('18.1.1.1', geolite) == 'USA'
 
@@ -88,12 +174,25 @@ def test_to_country_uses_xxx_for_non_countries(geolite):
     assert to_country('127.0.0.1', geolite) == 'XXX'
 
 
+def test_to_country_uses_raw_reader(geolite, geolite_raw):
+    for ip in ('18.1.1.1', '127.0.0.1', '2001:4860:4860::8888', '::1'):
+        assert to_country(ip, geolite_raw) == to_country(ip, geolite)
+
+
 def test_add_country_skips_requests_without_valid_country(geolite):
     reqs = add_country([{'remote_host': 'foobar'},
                         {'remote_host': '127.0.0.1'}], geolite)
     assert list(reqs) == [{'remote_host': '127.0.0.1', 'country': 'XXX'}]
 
 
+def test_add_country_caches_lookups(geolite):
+    cache = LRUCache(10)
+    reqs = add_country([{'remote_host': '18.1.1.1'},
+                        {'remote_host': '18.1.1.1'}], geolite, cache)
+    assert [r['country'] for r in reqs] == ['USA', 'USA']
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
 def test_get_bitstream_returns_json(session):
     with requests_mock.Mocker() as m:
         m.get('mock://example.com', json={'foo': 'bar'})
@@ -109,6 +208,17 @@ def test_get_bistream_caches_requests(session):
         assert m.call_count == 1
 
 
+def test_get_bitstream_uses_identity_cache(session, tmpdir):
+    identities.configure(str(tmpdir.join('identities.db')))
+    with requests_mock.Mocker() as m:
+        m.get('mock://example.com', json={'foo': 'bar'})
+        get_bitstream('123.4/5', 'mock://example.com/', session)
+        region.invalidate()
+        assert get_bitstream('123.4/5', 'mock://example.com/',
+                             session) == {'foo': 'bar'}
+        assert m.call_count == 1
+
+
 def test_get_bitstream_returns_none_on_failure(session):
     with requests_mock.Mocker() as m:
         m.get('mock://example.com', status_code=500)
@@ -116,6 +226,29 @@ def test_get_bitstream_returns_none_on_failure(session):
         assert bs is None
 
 
+def test_get_bitstream_does_not_persist_server_errors(session, tmpdir):
+    identities.configure(str(tmpdir.join('identities.db')))
+    with requests_mock.Mocker() as m:
+        m.get('mock://example.com', status_code=503)
+        assert get_bitstream('123.4/5', 'mock://example.com/',
+                             session) is None
+        region.invalidate()
+        m.get('mock://example.com', json={'success': True})
+        assert get_bitstream('123.4/5', 'mock://example.com/',
+                             session) == {'success': True}
+
+
+def test_get_bitstream_persists_missing_handles(session, tmpdir):
+    identities.configure(str(tmpdir.join('identities.db')))
+    with requests_mock.Mocker() as m:
+        m.get('mock://example.com', status_code=404)
+        get_bitstream('123.4/5', 'mock://example.com/', session)
+        region.invalidate()
+        assert get_bitstream('123.4/5', 'mock://example.com/',
+                             session) is None
+        assert m.call_count == 1
+
+
 def test_add_identities_adds_new_data(session, id_req):
     with requests_mock.Mocker() as m:
         m.get('mock://example.com', json=id_req)
@@ -165,3 +298,45 @@ def test_to_csv_quotes_end_of_data():
 def test_to_csv_returns_null_values():
     row = to_csv(['foo', '', ''])
     assert row == 'foo,,'
+
+
+def test_fetch_identities_fetches_concurrently(session, dspace_server):
+    url = 'http://127.0.0.1:{}/ws'.format(dspace_server.server_address[1])
+    reqs = [{'request_url': '/openaccess-disseminate/1721.1/{}'.format(i)}
+            for i in (1, 2, 3, 4, 5, 6, 7, 8, 1, 2)]
+    configure_session(session, concurrency=8)
+    start = time.time()
+    serial = list(fetch_identities(reqs[:8], url, session))
+    serial_time = time.time() - start
+    region.invalidate()
+    start = time.time()
+    concurrent = list(fetch_identities(reqs, url, session, concurrency=8))
+    concurrent_time = time.time() - start
+    assert serial_time >= 0.8
+    assert concurrent_time < serial_time / 2
+    assert [r for r, _ in concurrent] == reqs
+    assert [d['uri'] for _, d in concurrent] == \
+        [d['uri'] for _, d in serial] + [d['uri'] for _, d in serial[:2]]
+
+
+def test_configure_session_retries_server_errors(session, dspace_server):
+    url = 'http://127.0.0.1:{}/ws'.format(dspace_server.server_address[1])
+    dspace_server.delay = 0
+    dspace_server.failures = 2
+    configure_session(session, retries=2)
+    assert get_bitstream('1721.1/1', url, session)['success']
+
+
+def test_collect_handles_returns_unique_handles(logs):
+    assert collect_handles(logs) == set(['1234.5/6789'])
+
+
+def test_prefetch_identities_caches_bitstreams(session, dspace_server):
+    url = 'http://127.0.0.1:{}/'.format(dspace_server.server_port)
+    handles = ['1234.5/{}'.format(i) for i in range(4)]
+    start = time.time()
+    fetched = list(prefetch_identities(handles, url, session, concurrency=4))
+    assert time.time() - start < 0.3
+    assert sorted(fetched) == handles
+    for handle in handles:
+        assert get_bitstream.get(handle) is not NO_VALUE
@@ -4,8 +4,10 @@ from __future__ import absolute_import
 import pytest
 from sqlalchemy import select, func
 
-from pipeline.db import (engine, authors, dlcs, documents)
-from pipeline.query import (get_or_create, get_author, get_dlc, get_document)
+from pipeline.db import (engine, authors, dlcs, documents, documents_authors,
+                         documents_dlcs)
+from pipeline.query import (get_or_create, get_author, get_dlc, get_document,
+                            DocumentResolver, resolve_documents)
 
 
 @pytest.yield_fixture
@@ -100,3 +102,101 @@ def test_get_document_caches_response(conn):
     conn.close()
     assert p_key == get_document('mock://handle.com/1', 'Some Foo', [], [],
                                 conn)
+
+
+def test_document_resolver_returns_document_ids(conn):
+    reqs = [{'handle': 'foo', 'title': 'Foo'},
+            {'handle': 'bar', 'title': 'Bar'},
+            {'handle': 'foo', 'title': 'Foo'}]
+    ids = DocumentResolver(conn).resolve(reqs)
+    docs = dict((h, i) for h, i in
+                conn.execute(select([documents.c.handle, documents.c.id])))
+    assert ids == docs
+    assert ids['foo'] < ids['bar']
+
+
+def test_document_resolver_uses_existing_rows(conn):
+    p_key = get_document('foo', 'Foo', [{'mitid': '1234', 'name': 'Bar'}],
+                         [], conn)
+    reqs = [{'handle': 'foo', 'title': 'Foo'},
+            {'handle': 'bar', 'title': 'Bar',
+             'authors': [{'mitid': '1234', 'name': 'Bar'}]}]
+    ids = DocumentResolver(conn).resolve(reqs)
+    assert ids['foo'] == p_key
+    assert conn.scalar(select([func.count('*')]).select_from(documents)) == 2
+    assert conn.scalar(select([func.count('*')]).select_from(authors)) == 1
+
+
+def test_document_resolver_links_authors_and_dlcs(conn):
+    a = [{'mitid': '1234', 'name': 'Bar, Foo'}, {'name': 'Baz, Foo'}]
+    d = [{'canonical': 'The Foo Dept.', 'display': 'Foo'},
+         {'display': 'Bar'}]
+    ids = DocumentResolver(conn).resolve([{'handle': 'foo', 'title': 'Foo',
+                                           'authors': a, 'dlcs': d}])
+    author = conn.scalar(select([authors.c.id]))
+    dlc = conn.scalar(select([dlcs.c.id]))
+    assert conn.execute(select([documents_authors.c.document_id,
+                                documents_authors.c.author_id])).\
+        fetchall() == [(ids['foo'], author)]
+    assert conn.execute(select([documents_dlcs.c.document_id,
+                                documents_dlcs.c.dlc_id])).\
+        fetchall() == [(ids['foo'], dlc)]
+
+
+def test_document_resolver_ignores_conflicting_inserts(conn):
+    resolver = DocumentResolver(conn)
+    resolver._lookup = lambda *args: None
+    conn.execute(documents.insert(), handle='foo', title='Foo')
+    resolver._resolve(documents, documents.c.handle,
+                      {'foo': {'handle': 'foo', 'title': 'Foo'}}, {})
+    assert conn.scalar(select([func.count('*')]).select_from(documents)) == 1
+
+
+def test_document_resolver_only_links_documents_it_creates(conn):
+    resolver = DocumentResolver(conn)
+    insert = resolver._insert
+
+    def concurrent_insert(table, *args):
+        if table is documents:
+            r = conn.execute(documents.insert(), handle='foo', title='Foo')
+            conn.execute(documents_authors.insert(),
+                         document_id=r.inserted_primary_key[0],
+                         author_id=resolver.authors['1234'])
+        return insert(table, *args)
+
+    resolver._insert = concurrent_insert
+    ids = resolver.resolve([{'handle': 'foo', 'title': 'Foo',
+                             'authors': [{'mitid': '1234', 'name': 'Bar'}]},
+                            {'handle': 'bar', 'title': 'Bar',
+                             'authors': [{'mitid': '1234', 'name': 'Bar'}]}])
+    assert sorted(conn.execute(select([documents_authors.c.document_id]))) \
+        == sorted([(ids['foo'],), (ids['bar'],)])
+
+
+def test_resolve_documents_pairs_requests_with_ids(conn):
+    reqs = [{'handle': h, 'title': h} for h in 'abcab']
+    resolved = list(resolve_documents(reqs, DocumentResolver(conn), size=2))
+    assert [r['handle'] for r, _ in resolved] == list('abcab')
+    assert resolved[0][1] == resolved[3][1]
+    assert len(set(doc_id for _, doc_id in resolved)) == 3
+
+
+def test_document_resolver_preloads_ids(conn):
+    p_key = get_document('foo', 'Foo', [{'mitid': '1234', 'name': 'Bar'}],
+                         [{'canonical': 'The Foo Dept.', 'display': 'Foo'}],
+                         conn)
+    resolver = DocumentResolver(conn)
+    resolver.preload()
+    assert resolver.documents == {'foo': p_key}
+    assert list(resolver.authors) == ['1234']
+    assert list(resolver.dlcs) == ['The Foo Dept.']
+
+
+def test_preloaded_document_resolver_skips_lookups(conn):
+    get_document('foo', 'Foo', [], [], conn)
+    resolver = DocumentResolver(conn)
+    resolver.preload()
+    lookups = []
+    resolver._lookup = lambda *args: lookups.append(args[2])
+    resolver.resolve([{'handle': 'foo', 'title': 'Foo'}])
+    assert lookups == []
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import bz2
+import gzip
+import io
+import os
+import threading
+
+import pytest
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+from pipeline.readers import (compression, mmap_lines, open_input, open_log,
+                              read_ahead, read_segment, segments)
+
+
+def test_segments_split_on_line_boundaries(log_file):
+    segs = list(segments([log_file], 200))
+    assert len(segs) > 1
+    with io.open(log_file, 'rb') as fp:
+        data = fp.read()
+    assert segs[0][1] == 0
+    assert segs[-1][2] == len(data)
+    for path, start, end in segs:
+        assert data[end-1:end] == b'\n'
+
+
+def test_read_segment_returns_all_lines(log_file, logs):
+    lines = [l for seg in segments([log_file], 200)
+             for l in read_segment(*seg)]
+    assert lines == logs.readlines()
+
+
+@pytest.mark.parametrize('opener', [
+    gzip.open, bz2.BZ2File,
+    pytest.param(lzma and lzma.open, marks=pytest.mark.skipif(
+        lzma is None, reason='requires lzma'))])
+def test_open_log_decompresses_files(opener, log_file, logs, tmpdir):
+    path = str(tmpdir.join('requests.log'))
+    with io.open(log_file, 'rb') as fp, opener(path, 'wb') as out:
+        out.write(fp.read())
+    assert compression(path) is not None
+    assert open_log(path).readlines() == logs.readlines()
+
+
+def test_open_log_decompresses_zstd_files(log_file, logs, tmpdir):
+    zstandard = pytest.importorskip('zstandard')
+    path = str(tmpdir.join('requests.log'))
+    with io.open(log_file, 'rb') as fp, io.open(path, 'wb') as out:
+        out.write(zstandard.ZstdCompressor().compress(fp.read()))
+    assert open_log(path).readlines() == logs.readlines()
+
+
+def test_open_log_opens_plain_files(log_file, logs):
+    assert compression(log_file) is None
+    assert open_log(log_file).readlines() == logs.readlines()
+
+
+def test_open_input_reads_compressed_and_plain_files(log_file, logs, tmpdir):
+    path = str(tmpdir.join('requests.log.gz'))
+    with io.open(log_file, 'rb') as fp, gzip.open(path, 'wb') as out:
+        out.write(fp.read())
+    expected = logs.readlines()
+    assert list(open_input([path, log_file])) == expected * 2
+
+
+@pytest.mark.skipif(not hasattr(os, 'mkfifo'), reason='requires mkfifo')
+@pytest.mark.parametrize('use_mmap', [False, True])
+def test_open_input_reads_fifos(use_mmap, log_file, logs, tmpdir):
+    fifo = str(tmpdir.join('requests.log'))
+    os.mkfifo(fifo)
+
+    def write():
+        with io.open(log_file, 'rb') as fp, io.open(fifo, 'wb') as out:
+            out.write(fp.read())
+
+    def read():
+        lines.extend(open_input([fifo], use_mmap))
+
+    lines = []
+    threads = [threading.Thread(target=f) for f in (write, read)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert not any(thread.is_alive() for thread in threads)
+    assert lines == logs.readlines()
+
+
+def test_read_ahead_yields_lines_in_order():
+    lines = ['{}\n'.format(i) for i in range(2500)]
+    assert list(read_ahead(iter(lines), size=2, batch=100)) == lines
+
+
+def test_read_ahead_raises_errors():
+    def lines():
+        yield 'foo\n'
+        raise IOError('bad file')
+    with pytest.raises(IOError):
+        list(read_ahead(lines(), batch=1))
+
+
+def test_read_ahead_stops_thread_when_closed():
+    threads = threading.active_count()
+    lines = read_ahead(('{}\n'.format(i) for i in range(100000)), size=1,
+                       batch=10)
+    next(lines)
+    lines.close()
+    assert threading.active_count() == threads
+
+
+def test_mmap_lines_returns_matching_lines(log_file, logs):
+    expected = [l for l in logs if '/openaccess-disseminate/' in l]
+    assert list(mmap_lines(log_file)) == expected
+
+
+def test_mmap_lines_reads_segments(log_file):
+    lines = [l for seg in segments([log_file], 200)
+             for l in mmap_lines(*seg)]
+    assert lines == list(mmap_lines(log_file))
+
+
+def test_mmap_lines_reads_last_line_without_newline(tmpdir):
+    path = tmpdir.join('requests.log')
+    path.write_binary(b'foo\nGET /openaccess-disseminate/1\nbar\n'
+                      b'GET /openaccess-disseminate/2')
+    assert list(mmap_lines(str(path))) == [
+        'GET /openaccess-disseminate/1\n', 'GET /openaccess-disseminate/2']
+
+
+def test_mmap_lines_skips_empty_files(tmpdir):
+    path = tmpdir.join('requests.log')
+    path.write_binary(b'')
+    assert list(mmap_lines(str(path))) == []
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import datetime
+
+import pytest
+from sqlalchemy.sql import select
+
+from pipeline.db import (engine, authors, dlcs, documents, documents_authors,
+                         documents_dlcs, author_downloads, dlc_downloads,
+                         document_downloads)
+from pipeline.rollup import count_downloads, rebuild
+from pipeline.sink import InsertSink
+from pipeline.summary import (rollup_author_objs, rollup_dlc_objs,
+                              rollup_handle_objs, rollup_overall)
+
+
+ROWS = [
+    ('200', 'USA', '/handle/1', '', '', '2015-08-31T10:00:00', '1'),
+    ('200', 'USA', '/handle/1', '', '', '2015-08-31T11:00:00', '1'),
+    ('200', 'GBR', '/handle/1', '', '', '2015-09-01T10:00:00', '1'),
+    ('200', '', '/handle/2', '', '', '2015-09-01T10:00:00', '2'),
+    ('200', 'USA', '/handle/2', '', '', '2015-09-02T23:59:59', '2'),
+]
+
+
+@pytest.yield_fixture
+def conn(db):
+    conn = engine().connect()
+    conn.execute(authors.insert(), [{'id': 1, 'mit_id': '1234',
+                                     'name': 'Foo'},
+                                    {'id': 2, 'mit_id': '5678',
+                                     'name': 'Bar'}])
+    conn.execute(dlcs.insert(), [{'id': 1, 'canonical_name': 'Dept',
+                                  'display_name': 'Department'}])
+    conn.execute(documents.insert(), [{'id': 1, 'handle': '1',
+                                       'title': 'One'},
+                                      {'id': 2, 'handle': '2',
+                                       'title': 'Two'}])
+    conn.execute(documents_authors.insert(),
+                 [{'document_id': 1, 'author_id': 1},
+                  {'document_id': 2, 'author_id': 1},
+                  {'document_id': 2, 'author_id': 2}])
+    conn.execute(documents_dlcs.insert(), [{'document_id': 1, 'dlc_id': 1}])
+    yield conn
+    conn.close()
+
+
+def rollups(conn):
+    return [sorted(tuple(r)[1:] for r in conn.execute(select([t])))
+            for t in (document_downloads, author_downloads, dlc_downloads)]
+
+
+def test_count_downloads_counts_by_document_day_and_country():
+    counts = count_downloads(ROWS)
+    assert counts[(1, datetime.date(2015, 8, 31), 'USA')] == 2
+    assert counts[(2, datetime.date(2015, 9, 1), '')] == 1
+    assert sum(counts.values()) == 5
+
+
+def test_insert_sink_updates_rollups(conn):
+    with InsertSink(engine(), commit_every=2, rollups=True) as sink:
+        for row in ROWS:
+            sink.write(row)
+    assert rollups(conn)[0] == [
+        (1, datetime.date(2015, 8, 31), 'USA', 2),
+        (1, datetime.date(2015, 9, 1), 'GBR', 1),
+        (2, datetime.date(2015, 9, 1), '', 1),
+        (2, datetime.date(2015, 9, 2), 'USA', 1)]
+    assert (1, datetime.date(2015, 9, 1), '', 1) in rollups(conn)[1]
+    assert (1, datetime.date(2015, 9, 1), 'GBR', 1) in rollups(conn)[2]
+
+
+def test_rebuild_matches_incremental_rollups(conn):
+    with InsertSink(engine(), rollups=True) as sink:
+        for row in ROWS:
+            sink.write(row)
+    expected = rollups(conn)
+    rebuild(conn)
+    assert rollups(conn) == expected
+
+
+def test_rebuild_only_replaces_date_range(conn):
+    with InsertSink(engine()) as sink:
+        for row in ROWS:
+            sink.write(row)
+    rebuild(conn, start=datetime.date(2015, 9, 1),
+            end=datetime.date(2015, 9, 2))
+    assert rollups(conn)[0] == [
+        (1, datetime.date(2015, 9, 1), 'GBR', 1),
+        (2, datetime.date(2015, 9, 1), '', 1)]
+    assert rollups(conn)[1] == [
+        (1, datetime.date(2015, 9, 1), '', 1),
+        (1, datetime.date(2015, 9, 1), 'GBR', 1),
+        (2, datetime.date(2015, 9, 1), '', 1)]
+
+
+def test_rollup_objs_summarize_rollups(conn):
+    with InsertSink(engine(), rollups=True) as sink:
+        for row in ROWS:
+            sink.write(row)
+    foo, bar = rollup_author_objs(conn)
+    assert foo['_id'] == {'name': 'Foo', 'mitid': '1234'}
+    assert foo['size'] == 2
+    assert foo['downloads'] == 5
+    assert foo['countries'] == [{'country': None, 'downloads': 1},
+                                {'country': 'GBR', 'downloads': 1},
+                                {'country': 'USA', 'downloads': 3}]
+    assert foo['dates'] == [{'date': '2015-08-31', 'downloads': 2},
+                            {'date': '2015-09-01', 'downloads': 2},
+                            {'date': '2015-09-02', 'downloads': 1}]
+    assert bar['downloads'] == 2
+    dlc, = rollup_dlc_objs(conn)
+    assert dlc['downloads'] == 3
+    one, two = rollup_handle_objs(conn)
+    assert one['_id'] == '1'
+    assert one['parents'] == [{'name': 'Foo', 'mitid': '1234'}]
+    assert two['downloads'] == 2
+    overall = rollup_overall(conn)
+    assert overall['downloads'] == 5
+    assert overall['size'] == 2
+    assert overall['dates'][0] == {'date': '2015-08-31', 'downloads': 2}
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import io
+
+import pytest
+from sqlalchemy.sql import select
+
+from pipeline import rollup
+from pipeline.db import (engine, countries, documents, referers,
+                         request_facts, request_table, requests, user_agents,
+                         value_hash)
+from pipeline.query import RequestEncoder
+from pipeline.schema import create_tables, drop_tables
+from pipeline.sink import CSVSink, InsertSink
+
+
+ROWS = [('200', 'USA', '/1', '-', 'Mozilla', '2015-08-31T10:00:00', '1'),
+        ('200', 'GBR', '/1', '', 'Mozilla', '2015-08-31T11:00:00', '1'),
+        ('404', '', '/1', '-', 'curl', '2015-09-01T10:00:00', '1')]
+
+
+@pytest.yield_fixture
+def conn():
+    engine.configure('sqlite://')
+    conn = engine().connect()
+    create_tables(conn, normalized=True)
+    conn.execute(documents.insert(), [{'id': 1, 'handle': '1'}])
+    yield conn
+    drop_tables(conn)
+    conn.close()
+
+
+@pytest.fixture
+def pg(postgres):
+    create_tables(postgres, normalized=True)
+    return postgres
+
+
+def long_referer(conn):
+    referer = 'http://example.com/?q=' + ''.join(value_hash(str(i))
+                                                 for i in range(320))
+    row = ('200', 'USA', '/1', referer, 'Mozilla', '2015-08-31T10:00:00',
+           '1')
+    first = RequestEncoder(conn).encode([row])[0]
+    assert RequestEncoder(conn).encode([row])[0] == first
+    assert conn.execute(select([referers.c.hash, referers.c.referer])
+                        .where(referers.c.id == int(first[3]))).first() == \
+        (value_hash(referer), referer)
+
+
+def test_create_tables_creates_normalized_schema(conn):
+    assert request_table(conn) is request_facts
+
+
+def test_request_encoder_replaces_values_with_ids(conn):
+    encoder = RequestEncoder(conn)
+    rows = encoder.encode(ROWS)
+    usa, gbr = rows[0][1], rows[1][1]
+    assert usa != gbr
+    assert rows[2][1] == ''
+    assert rows[0][3] == rows[2][3] != ''
+    assert rows[1][3] == ''
+    assert rows[0][4] == rows[1][4] != rows[2][4]
+    assert rows[0][5:] == ROWS[0][5:]
+    assert conn.scalar(select([countries.c.code])
+                       .where(countries.c.id == int(usa))) == 'USA'
+
+
+def test_request_encoder_looks_up_long_values_by_hash(conn):
+    long_referer(conn)
+
+
+def test_request_encoder_looks_up_long_values_by_hash_on_postgres(pg):
+    long_referer(pg)
+
+
+def test_request_encoder_reuses_ids(conn):
+    first = RequestEncoder(conn).encode(ROWS)
+    encoder = RequestEncoder(conn)
+    encoder.preload()
+    assert encoder.encode(ROWS) == first
+    assert len(list(conn.execute(select([user_agents])))) == 2
+
+
+def test_insert_sink_writes_normalized_requests(conn):
+    with InsertSink(engine()) as sink:
+        for row in ROWS:
+            sink.write(row)
+    assert len(list(conn.execute(select([request_facts])))) == 3
+    rows = conn.execute(select([requests.c.status, requests.c.country,
+                                requests.c.referer, requests.c.user_agent])
+                        .order_by(requests.c.id)).fetchall()
+    assert [tuple(r) for r in rows] == [(200, 'USA', '-', 'Mozilla'),
+                                        (200, 'GBR', None, 'Mozilla'),
+                                        (404, None, '-', 'curl')]
+
+
+def test_insert_sink_forgets_ids_rolled_back(conn, monkeypatch):
+    def fail(*args):
+        raise ValueError
+    monkeypatch.setattr(rollup, 'update', fail)
+    with InsertSink(engine(), commit_every=0, rollups=True) as sink:
+        sink.write(ROWS[0])
+        with pytest.raises(ValueError):
+            sink.flush()
+        assert conn.scalar(select([user_agents.c.id])) is None
+        monkeypatch.undo()
+    rows = conn.execute(select([requests.c.country, requests.c.referer,
+                                requests.c.user_agent])).fetchall()
+    assert [tuple(r) for r in rows] == [('USA', '-', 'Mozilla')]
+
+
+def test_csv_sink_writes_normalized_layout(conn):
+    stream = io.StringIO()
+    with CSVSink(stream, engine=engine()) as sink:
+        for row in ROWS:
+            sink.write(row)
+    lines = stream.getvalue().splitlines()
+    assert lines[2] == '404,,/1,1,2,2015-09-01T10:00:00,1'
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import io
+
+import pytest
+
+from pipeline.pipeline import to_csv
+from pipeline.sink import CopySink, CSVSink
+
+
+class Cursor(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def copy_expert(self, sql, fp):
+        self.conn.calls.append(('copy', fp.read()))
+
+    def close(self):
+        pass
+
+
+class Transaction(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.conn.calls.append(('commit',) if exc_type is None
+                               else ('rollback',))
+
+
+class Dialect(object):
+    name = 'fake'
+
+    def has_table(self, conn, name):
+        return False
+
+
+class Connection(object):
+    def __init__(self):
+        self.calls = []
+        self.connection = self
+        self.dialect = Dialect()
+
+    def begin(self):
+        return Transaction(self)
+
+    def cursor(self):
+        return Cursor(self)
+
+    def close(self):
+        self.calls.append(('close',))
+
+
+class Engine(object):
+    def __init__(self):
+        self.conn = Connection()
+
+    def connect(self):
+        return self.conn
+
+
+@pytest.fixture
+def engine():
+    return Engine()
+
+
+def test_copy_sink_copies_rows_in_chunks(engine):
+    with CopySink(engine, commit_every=2) as sink:
+        for i in range(3):
+            sink.write(('200', 'USA', 'foo,bar', '', '', 'now', str(i)))
+    assert engine.conn.calls == [
+        ('copy', '200,USA,"foo,bar",,,now,0\n200,USA,"foo,bar",,,now,1\n'),
+        ('commit',),
+        ('copy', '200,USA,"foo,bar",,,now,2\n'),
+        ('commit',),
+        ('close',)]
+
+
+def test_copy_sink_discards_rows_on_error(engine):
+    with pytest.raises(ValueError):
+        with CopySink(engine, commit_every=2) as sink:
+            sink.write(('200', 'USA', 'foo', '', '', 'now', '1'))
+            raise ValueError
+    assert engine.conn.calls == [('close',)]
+
+
+def test_csv_sink_matches_to_csv():
+    rows = [('200', 'USA', 'foo,bar', '', 'A "UA"', 'now', '1'),
+            ('200', 'USA', '\\.', 'a\nb', '', 'now', '2'),
+            ('200', 'USA', 'foo', '', '', 'now', '3')]
+    stream = io.StringIO()
+    with CSVSink(stream, buffer_rows=2) as sink:
+        for row in rows:
+            sink.write(row)
+    assert stream.getvalue() == ''.join(to_csv(r) + '\n' for r in rows)
+
+
+def test_csv_sink_writes_in_blocks():
+    stream = io.StringIO()
+    sink = CSVSink(stream, buffer_rows=2)
+    sink.write(('foo',))
+    assert stream.getvalue() == ''
+    sink.write(('bar',))
+    assert stream.getvalue() == 'foo\nbar\n'
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from datetime import datetime
+
+from click.testing import CliRunner
+import pytest
+from sqlalchemy.sql import select
+
+from pipeline.cli import main
+from pipeline.db import (engine, authors, dlcs, documents, documents_authors,
+                         documents_dlcs, requests)
+from pipeline.summary import (author_objs, bulk_author_objs, bulk_dlc_objs,
+                              bulk_handle_objs, dlc_objs, handle_objs, merge,
+                              merged, get_watermark, set_watermark, _window)
+
+
+REQUESTS = [
+    ('USA', datetime(2015, 8, 31, 10, 0), 1),
+    ('USA', datetime(2015, 8, 31, 23, 59, 59), 1),
+    (None, datetime(2015, 9, 1, 0, 0), 1),
+    ('GBR', datetime(2015, 9, 1, 12, 0), 2),
+    (None, datetime(2015, 9, 2, 8, 30), 2),
+    ('USA', datetime(2015, 9, 2, 9, 0), 2),
+]
+
+MORE_REQUESTS = [
+    ('GBR', datetime(2015, 9, 2, 10, 0), 1),
+    (None, datetime(2015, 9, 3, 0, 0), 3),
+    ('USA', datetime(2015, 9, 3, 1, 0), 3),
+]
+
+
+def date_trunc(unit, value):
+    assert unit == 'day'
+    return value[:10] + ' 00:00:00'
+
+
+def add_requests(conn, rows):
+    conn.execute(requests.insert(),
+                 [{'status': 200, 'country': country, 'url': '/',
+                   'datetime': time, 'document_id': doc_id}
+                  for country, time, doc_id in rows])
+
+
+@pytest.yield_fixture
+def conn(db):
+    conn = engine().connect()
+    conn.connection.create_function('date_trunc', 2, date_trunc)
+    conn.execute(authors.insert(), [
+        {'id': 1, 'mit_id': '1234', 'name': 'Foo'},
+        {'id': 2, 'mit_id': '5678', 'name': 'Bar'},
+        {'id': 3, 'mit_id': '9012', 'name': 'Baz'}])
+    conn.execute(dlcs.insert(), [
+        {'id': 1, 'canonical_name': 'Dept', 'display_name': 'Department'},
+        {'id': 2, 'canonical_name': 'Other', 'display_name': 'Other'}])
+    conn.execute(documents.insert(), [
+        {'id': 1, 'handle': '1', 'title': 'One'},
+        {'id': 2, 'handle': '2', 'title': 'Two'},
+        {'id': 3, 'handle': '3', 'title': 'Three'}])
+    conn.execute(documents_authors.insert(), [
+        {'document_id': 1, 'author_id': 1},
+        {'document_id': 2, 'author_id': 1},
+        {'document_id': 2, 'author_id': 2},
+        {'document_id': 3, 'author_id': 2}])
+    conn.execute(documents_dlcs.insert(), [
+        {'document_id': 1, 'dlc_id': 1},
+        {'document_id': 2, 'dlc_id': 1}])
+    add_requests(conn, REQUESTS)
+    yield conn
+    conn.close()
+
+
+def summarize(*args):
+    res = CliRunner().invoke(main, ['summary', '--database', 'sqlite://'] +
+                             list(args))
+    assert res.exit_code == 0, res.output
+
+
+def test_bulk_author_objs_match_author_objs(conn):
+    objs = list(bulk_author_objs(conn))
+    assert objs == list(author_objs(conn))
+    assert [o['downloads'] for o in objs] == [6, 3, 0]
+    assert objs[0]['countries'][0] == {'country': None, 'downloads': 2}
+
+
+def test_bulk_dlc_objs_match_dlc_objs(conn):
+    objs = list(bulk_dlc_objs(conn))
+    assert objs == list(dlc_objs(conn))
+    assert [o['downloads'] for o in objs] == [6, 0]
+
+
+def test_bulk_handle_objs_match_handle_objs(conn):
+    objs = list(bulk_handle_objs(conn))
+    assert objs == list(handle_objs(conn))
+    assert [o['downloads'] for o in objs] == [3, 3, 0]
+    assert objs[0]['dates'] == [{'date': '2015-08-31', 'downloads': 2},
+                                {'date': '2015-09-01', 'downloads': 1}]
+
+
+def by_country(objs):
+    """Sort the countries of ``objs`` with SQLite's NULLs first."""
+    objs = [dict(o) for o in objs]
+    for obj in objs:
+        obj['countries'] = sorted(obj.get('countries', []),
+                                  key=lambda c: (c['country'] is not None,
+                                                 c['country']))
+    return sorted(objs, key=lambda o: repr(o['_id']))
+
+
+def test_merge_returns_delta_without_existing_object():
+    delta = {'type': 'handle', 'downloads': 1}
+    assert merge(None, delta) == delta
+
+
+def test_merge_adds_counts():
+    existing = {'type': 'handle', 'downloads': 3, 'title': 'Old',
+                'countries': [{'country': 'USA', 'downloads': 3}],
+                'dates': [{'date': '2015-08-31', 'downloads': 3}]}
+    delta = {'type': 'handle', 'downloads': 2, 'title': 'New',
+             'countries': [{'country': 'GBR', 'downloads': 1},
+                           {'country': 'USA', 'downloads': 1}],
+             'dates': [{'date': '2015-08-31', 'downloads': 1},
+                       {'date': '2015-09-01', 'downloads': 1}]}
+    obj = merge(existing, delta)
+    assert obj['title'] == 'New'
+    assert obj['downloads'] == 5
+    assert obj['countries'] == [{'country': 'GBR', 'downloads': 1},
+                                {'country': 'USA', 'downloads': 4}]
+    assert obj['dates'] == [{'date': '2015-08-31', 'downloads': 4},
+                            {'date': '2015-09-01', 'downloads': 1}]
+
+
+def test_merged_merges_objects_with_collection(collection):
+    collection.insert_many([{'_id': {'mitid': '1234'}, 'downloads': 2}])
+    objs = merged(collection, iter([{'_id': {'mitid': '1234'},
+                                     'downloads': 1},
+                                    {'_id': {'mitid': '5678'},
+                                     'downloads': 1}]), size=1)
+    assert [o['downloads'] for o in objs] == [3, 1]
+
+
+def test_get_watermark_returns_none_without_watermark(conn):
+    assert get_watermark(conn, 'oastats.summary') is None
+
+
+def test_set_watermark_replaces_watermark(conn):
+    set_watermark(conn, 'oastats.summary', 3, datetime(2015, 9, 1))
+    set_watermark(conn, 'oastats.summary', 6, datetime(2015, 9, 2))
+    set_watermark(conn, 'oastats.other', 1, datetime(2015, 8, 31))
+    assert get_watermark(conn, 'oastats.summary') == 6
+    assert get_watermark(conn, 'oastats.other') == 1
+
+
+def test_window_limits_request_ids(conn):
+    ids = select([requests.c.id]).order_by(requests.c.id)
+    assert [r[0] for r in conn.execute(_window(ids, 2, 4))] == [3, 4]
+    assert [r[0] for r in conn.execute(_window(ids, 4, None))] == [5, 6]
+    assert [r[0] for r in conn.execute(_window(ids, None, 2))] == [1, 2]
+
+
+def test_bulk_objs_since_only_include_touched_entities(conn):
+    foo, bar = bulk_author_objs(conn, since=3, until=6)
+    assert foo['_id'] == {'name': 'Foo', 'mitid': '1234'}
+    assert foo['downloads'] == bar['downloads'] == 3
+    dlc, = bulk_dlc_objs(conn, since=3, until=6)
+    assert dlc['downloads'] == 3
+    two, = bulk_handle_objs(conn, since=3, until=6)
+    assert two['_id'] == '2'
+    assert two['countries'] == [{'country': None, 'downloads': 1},
+                                {'country': 'GBR', 'downloads': 1},
+                                {'country': 'USA', 'downloads': 1}]
+    assert not list(bulk_handle_objs(conn, since=6, until=6))
+
+
+def test_summary_incremental_adds_new_requests(conn, mongo):
+    summarize('--incremental')
+    assert get_watermark(conn, 'oastats.summary') == 6
+    add_requests(conn, MORE_REQUESTS)
+    summarize('--incremental')
+    assert get_watermark(conn, 'oastats.summary') == 9
+    summarize('--mongo-coll', 'full')
+    assert by_country(mongo['summary'].find()) == \
+        by_country(mongo['full'].find())
+    assert mongo['summary'].find_one({'_id': 'Overall'})['downloads'] == 9